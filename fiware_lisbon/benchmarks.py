@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+  Micro-benchmarks of the import's hot paths, on synthetic data
+  shaped like OST's. Run them on the project's directory:
+
+    python benchmarks.py serializer payload codec flatten
+"""
+import csv
+import json
+import os
+import sys
+import time
+from itertools import chain
+
+import simplejson
+
+from utils.constants import STOP
+from utils.constants import STOPTIME
+from fiware.importer import FiWare
+from fiware.serializer import ElementSerializer
+from fiware.serializer import KeyValuesSerializer
+from utils import codec
+from utils.flatten import records_to_csv
+from utils.utils import to_keyvalue_pairs
+
+
+def make_stoptimes(count):
+    """ Returns `count` OST-like StopTimes """
+    return [{
+        'id': index,
+        'resource_uri': '/api/v1/stoptimes/{}/'.format(index),
+        'arrival_time': '08:{:02d}:00'.format(index % 60),
+        'departure_time': '08:{:02d}:30'.format(index % 60),
+        'stop_sequence': index % 30,
+        'stop_headsign': '',
+        'pickup_type': 0,
+        'drop_off_type': 0,
+        'shape_dist_traveled': None,
+        'stop': {
+            'id': index % 500,
+            'resource_uri': '/api/v1/stops/{}/'.format(index % 500),
+        },
+        'trip': {'resource_uri': '/api/v1/trips/{}/'.format(index // 30)},
+    } for index in xrange(count)]
+
+
+def make_stops(count):
+    """ Returns `count` OST-like Stops """
+    return [{
+        'id': index,
+        'resource_uri': '/api/v1/stops/{}/'.format(index),
+        'stop_name': u'Estação {}'.format(index),
+        'stop_code': str(index),
+        'point': {
+            'type': 'Point',
+            'coordinates': [-9.1 - index * 1e-5, 38.7 + index * 1e-5],
+        },
+        'agency': {'id': 1, 'resource_uri': '/api/v1/agencies/1/'},
+    } for index in xrange(count)]
+
+
+def measure(function, records, repeat=3):
+    """ Returns the best records/s of `repeat` runs of function(records) """
+    best = None
+    for _ in xrange(repeat):
+        started_at = time.time()
+        function(records)
+        elapsed = time.time() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return len(records) / best
+
+
+def report(title, results):
+    """ Prints records/s of each variant and its speed-up to the first """
+    print '\n' + title
+    baseline = results[0][1]
+    for name, records_per_second in results:
+        print '  {:<28} {:>12,.0f} records/s  x{:.1f}'.format(
+            name,
+            records_per_second,
+            records_per_second / baseline,
+        )
+
+
+def bench_serializer(count=50000):
+    """ FiWare.wrap_content (per record) against ElementSerializer """
+    for content_type, records in ((STOPTIME, make_stoptimes(count)),
+                                  (STOP, make_stops(count))):
+        def wrap_content(records):
+            # wrap_content pops resource_uri, so it gets a copy
+            return [FiWare.wrap_content(dict(each), content_type)
+                    for each in records]
+
+        def wrap_many(records):
+            serializer = ElementSerializer(content_type, FiWare.wrap_element)
+            return serializer.wrap_many(records)
+        report('{} serialization ({} records)'.format(content_type, count), [
+            ('wrap_content', measure(wrap_content, records)),
+            ('ElementSerializer.wrap_many', measure(wrap_many, records)),
+        ])
+
+
+def bench_payload(count=10000):
+    """ Bytes sent per record with NGSI10 and NGSIv2 keyValues """
+    for content_type, records in ((STOPTIME, make_stoptimes(count)),
+                                  (STOP, make_stops(count))):
+        print '\n{} payload ({} records)'.format(content_type, count)
+        baseline = None
+        for serializer_class in (ElementSerializer, KeyValuesSerializer):
+            serializer = serializer_class(content_type, FiWare.wrap_element)
+            size = len(serializer.wrap_many(records)) / float(count)
+            baseline = baseline or size
+            print '  {:<28} {:>12,.0f} bytes/record  x{:.2f}'.format(
+                serializer_class.__name__,
+                size,
+                size / baseline,
+            )
+        records_per_second = measure(
+            KeyValuesSerializer(content_type).wrap_many,
+            records,
+        )
+        print '  {:<28} {:>12,.0f} records/s'.format(
+            'KeyValuesSerializer speed',
+            records_per_second,
+        )
+
+
+def bench_codec(count=200, page_size=500):
+    """
+      Decoding OST pages and encoding payloads with each JSON backend
+      (the real share of a run is printed by the import's stages)
+    """
+    pages = [simplejson.dumps({
+        'Objects': make_stoptimes(page_size),
+        'Meta': {'next_page': '/api/v1/stoptimes/?page=2'},
+    }) for _ in xrange(count)]
+    objects = [simplejson.loads(page)['Objects'] for page in pages]
+    decoders = [('json', json.loads), ('simplejson', simplejson.loads)]
+    encoders = [('json', json.dumps), ('simplejson', simplejson.dumps)]
+    try:
+        import ujson
+        decoders.append(('ujson', ujson.loads))
+    except ImportError:
+        pass
+
+    def records_per_second(function, items):
+        return measure(lambda items: map(function, items), items) * page_size
+    print '\nutils.codec decodes with {} and encodes with {}'.format(
+        codec.LOADS_BACKEND,
+        codec.DUMPS_BACKEND,
+    )
+    report('Decoding OST pages ({} x {} records)'.format(count, page_size), [
+        (name, records_per_second(function, pages))
+        for name, function in decoders + [('codec.loads', codec.loads)]
+    ])
+    report('Encoding ({} x {} records)'.format(count, page_size), [
+        (name, records_per_second(function, objects))
+        for name, function in encoders + [('codec.dumps', codec.dumps)]
+    ])
+
+
+def bench_flatten(count=200000):
+    """
+      Flattening records into CSV rows: to_keyvalue_pairs and the
+      old dicts_to_csv (every row in memory) against utils.flatten
+    """
+    records = make_stoptimes(count)
+
+    def dicts_to_csv(records):
+        # dicts_to_csv before utils.flatten
+        source = [dict(to_keyvalue_pairs(record)) for record in records]
+        keys = sorted(set(chain.from_iterable([o.keys() for o in source])))
+        rows = [[each.get(key) for key in keys] for each in source]
+        with open(os.devnull, 'w') as output_file:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(keys)
+            for row in rows:
+                writer.writerow([
+                    column.encode('utf-8') if isinstance(column, unicode)
+                    else column for column in row
+                ])
+
+    def flatten(records):
+        with open(os.devnull, 'w') as output_file:
+            records_to_csv(iter(records), output_file)
+    report('StopTimes to CSV ({} records)'.format(count), [
+        ('to_keyvalue_pairs + dicts_to_csv', measure(dicts_to_csv, records)),
+        ('utils.flatten.records_to_csv', measure(flatten, records)),
+    ])
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'flatten': bench_flatten,
+    'payload': bench_payload,
+    'serializer': bench_serializer,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
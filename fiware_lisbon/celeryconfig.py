@@ -22,10 +22,15 @@ BEAT_NAME_CB = 'import_gtfs_to_fiware'
 BEAT_TIME_CB = time(06, 00)
 BEAT_NAME_CKAN = 'import_gtfs_to_ckan'
 BEAT_TIME_CKAN = time(06, 30)
+BEAT_NAME_DEFERRED = 'resolve_deferred_places'
+# Hours at which Places without an address are geocoded again
+BEAT_HOURS_DEFERRED = '*/6'
 
 BEAT_QUEUE = 'fiware_queue'
 
 CELERY_IMPORTS = ('fiware.tasks', 'ckan.tasks',)
+# Stages sent by the beat tasks go to the same queue
+CELERY_DEFAULT_QUEUE = BEAT_QUEUE
 CELERYD_CONCURRENCY = 2
 CELERY_RESULT_BACKEND = 'amqp'
 CELERY_TASK_RESULT_EXPIRES = 60 * 5
@@ -52,4 +57,15 @@ CELERYBEAT_SCHEDULE = {
             'queue': BEAT_QUEUE,
         }
     },
+    BEAT_NAME_DEFERRED: {
+        'task': 'resolve_deferred_places',
+        'schedule': crontab(
+            hour=BEAT_HOURS_DEFERRED,
+            minute=BEAT_TIME_CKAN.minute + 15,
+        ),
+        'args': (),
+        'options': {
+            'queue': BEAT_QUEUE,
+        }
+    },
 }
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import math
+
+try:
+    import shapefile
+except ImportError:
+    shapefile = None
+
+from utils.codec import loads
+from utils.constants import CAOP_BOUNDARIES
+from utils.constants import CAOP_MUNICIPALITY_FIELD
+from utils.constants import CAOP_PARISH_FIELD
+
+
+# Polygons (or nodes) per node of the R-tree
+NODE_CAPACITY = 16
+
+
+def get_bbox(rings):
+    """ Returns the (min x, min y, max x, max y) of a polygon's rings """
+    xs = [x for ring in rings for x, _ in ring]
+    ys = [y for ring in rings for _, y in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def merge_bboxes(bboxes):
+    """ Returns the bounding box of a list of bounding boxes """
+    return (
+        min(bbox[0] for bbox in bboxes),
+        min(bbox[1] for bbox in bboxes),
+        max(bbox[2] for bbox in bboxes),
+        max(bbox[3] for bbox in bboxes),
+    )
+
+
+def contains(rings, x, y):
+    """
+      Ray casting (even-odd rule) over every ring of a polygon,
+      so points inside its holes are outside of it.
+    """
+    inside = False
+    for ring in rings:
+        x1, y1 = ring[-1]
+        for x2, y2 in ring:
+            if (y1 > y) != (y2 > y) and \
+                    x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+                inside = not inside
+            x1, y1 = x2, y2
+    return inside
+
+
+def pack(entries, capacity=NODE_CAPACITY):
+    """
+      Sort-Tile-Recursive packing of (bbox, item) entries into an
+      R-tree level: entries are sorted by x into vertical slices,
+      each slice by y, and grouped into nodes of `capacity` entries.
+      Returns the nodes as (bbox, entries) entries of the next level.
+    """
+    node_count = int(math.ceil(len(entries) / float(capacity)))
+    slice_count = int(math.ceil(math.sqrt(node_count)))
+    slice_size = slice_count * capacity
+    entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+    nodes = []
+    for start in xrange(0, len(entries), slice_size):
+        vertical_slice = sorted(
+            entries[start:start + slice_size],
+            key=lambda entry: entry[0][1] + entry[0][3],
+        )
+        for index in xrange(0, len(vertical_slice), capacity):
+            children = vertical_slice[index:index + capacity]
+            nodes.append((
+                merge_bboxes([child[0] for child in children]),
+                children,
+            ))
+    return nodes
+
+
+class Boundaries(object):
+    """
+      Administrative boundaries (e.g. CAOP's parishes) held in a
+      STR-packed R-tree, so that the parish and municipality of a
+      point are found locally instead of asking OST's whereat.
+      Coordinates are WGS84 (longitude, latitude).
+    """
+
+    def __init__(self, features, parish_field=CAOP_PARISH_FIELD,
+                 municipality_field=CAOP_MUNICIPALITY_FIELD):
+        self.parish_field = parish_field
+        self.municipality_field = municipality_field
+        # Leaves are (bbox, (rings, properties)), one per polygon
+        entries = []
+        for geometry, properties in features:
+            if not geometry:
+                continue
+            if geometry['type'] == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            for polygon in polygons:
+                rings = [[tuple(point[:2]) for point in ring]
+                         for ring in polygon if ring]
+                if rings:
+                    entries.append((get_bbox(rings), (rings, properties)))
+        self.size = len(entries)
+        # Only the leaves' level holds polygons, the others hold nodes
+        self.height = 0
+        while len(entries) > 1:
+            entries = pack(entries)
+            self.height += 1
+        self.root = entries[0] if entries else None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """ Loads a GeoJSON (.geojson/.json) or Shapefile (.shp) """
+        if path.lower().endswith('.shp'):
+            if shapefile is None:
+                raise ImportError('pyshp is needed to read ' + path)
+            reader = shapefile.Reader(path)
+            fields = [field[0] for field in reader.fields[1:]]
+            features = [(
+                shape_record.shape.__geo_interface__,
+                dict(zip(fields, shape_record.record)),
+            ) for shape_record in reader.iterShapeRecords()]
+        else:
+            with open(path, 'rb') as geojson:
+                collection = loads(geojson.read())
+            features = [(
+                feature.get('geometry'),
+                feature.get('properties') or {},
+            ) for feature in collection['features']]
+        return cls(features, **kwargs)
+
+    def find(self, x, y):
+        """ Returns the properties of the polygon containing (x, y) """
+        if self.root is None:
+            return None
+        stack = [(self.root, self.height)]
+        while stack:
+            (bbox, content), level = stack.pop()
+            if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            if level == 0:
+                rings, properties = content
+                if contains(rings, x, y):
+                    return properties
+            else:
+                stack.extend((child, level - 1) for child in content)
+        return None
+
+    def locate(self, coords):
+        """
+          Returns the parish and municipality of (latitude, longitude)
+          shaped like whereat's ({'name': ...}, or {} when unknown).
+        """
+        properties = self.find(float(coords[1]), float(coords[0]))
+        if properties is None:
+            return {}, {}
+        parish = properties.get(self.parish_field)
+        municipality = properties.get(self.municipality_field)
+        return (
+            {'name': parish} if parish else {},
+            {'name': municipality} if municipality else {},
+        )
+
+    def locate_many(self, coords_list):
+        """ Batched locate(), in the same order as coords_list """
+        return [self.locate(coords) for coords in coords_list]
+
+
+def load_boundaries(path=CAOP_BOUNDARIES):
+    """
+      Loads the boundaries file set in CAOP_BOUNDARIES, if any.
+      Returns None when there's none (whereat is used instead).
+    """
+    if not path:
+        return None
+    return Boundaries.from_file(path)
@@ -2,35 +2,39 @@
 # encoding: utf-8
 import csv
 import glob
-import json
 import os
 import re
-import subprocess
 import time
+from codecs import BOM_UTF8
+from functools import partial
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from string import capwords
 from zipfile import ZipFile
 
 import requests
 from colorama import Fore
+from requests.exceptions import RequestException
 from datastore.ckan_client import CkanClient
 from datastore.ckan_client import CkanAccessDenied
 from datastore.ckan_client import CkanNotFound
-from datastore.datastore_loader import upload_resource_to_datastore
-from geopy.geocoders import GoogleV3
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from geopy.exc import GeocoderQuotaExceeded
-from geopy.exc import GeocoderServiceError
 
 # CKAN related
 from utils.constants import CKAN_API_KEY
+from utils.constants import CKAN_BATCH_BYTES
+from utils.constants import CKAN_BATCH_SIZE
 from utils.constants import CKAN_AUTHORIZATION as CKAN_AUTH
 from utils.constants import CKAN_DATASET
+from utils.constants import CKAN_DATASET_FIELDS
+from utils.constants import CKAN_EXPORT_PAGE_SIZE
+from utils.constants import CKAN_EXPORT_WORKERS
 from utils.constants import CKAN_CARRIS_DATASET
 from utils.constants import CKAN_CP_DATASET
 from utils.constants import CKAN_HOST
 from utils.constants import CKAN_PWD
 from utils.constants import CKAN_RESOURCE_NAME
+from utils.constants import CKAN_RETRIES
+from utils.constants import CKAN_WORKERS
 # OST related
 from utils.constants import OST_API_KEY
 from utils.constants import OST_API_MAIN_URL
@@ -39,24 +43,33 @@ from utils.constants import OST_GTFS_PARAMS_CP
 from utils.constants import OST_LOGIN_URL
 from utils.constants import OST_RECEPTION_API
 from utils.constants import OST_RECEPTION_COORDS
-# JSON to CSV related
-from utils.utils import to_keyvalue_pairs as to_keyval
-from utils.utils import json_to_csv
+# JSON related
+from utils.codec import dumps
+from utils.codec import loads
 # GTFS and API related
 from fiware.crawler import Crawler
+from boundaries import load_boundaries
+from deferred import DeferredPlaces
+from geocache import GeocodeCache
+from geocoders import get_geocoder_pool
 from utils.constants import BUS
 from utils.constants import CARRIS_NAME
 from utils.constants import CARRIS_URL
 from utils.constants import CP_NAME
 from utils.constants import CP_URL
 from utils.constants import DATASETS_NAMES
+from utils.constants import DEFERRED_BATCH
+from utils.constants import DOWNLOAD_CHUNK_SIZE
+from utils.constants import GEOCODE_CACHE_WARM
 from utils.constants import GTFS_EXTENSION
 from utils.constants import GTFS_RESOURCES
 from utils.constants import JSON
 from utils.constants import PLACE_BODY
+from utils.constants import PLACES_PRIMARY_KEY
 from utils.constants import STOP
 from utils.constants import TRAIN
 from utils.constants import TRANSPORTATION_CATEGORY
+from utils.constants import UNKNOWN_ADDRESS
 from utils.errors import CKANError
 from utils.utils import get_ckan_api
 from utils.utils import get_ckan_error
@@ -64,62 +77,126 @@ from utils.utils import get_extension
 from utils.utils import get_file_path
 from utils.utils import get_ost_api
 from utils.utils import get_string_type
-from utils.utils import grouper
+from utils.utils import imap_bounded
+from utils.utils import batches
+from utils.download import check_zip
+from utils.download import download
+from utils.download import PART_SUFFIX
+from utils.flatten import CSVWriter
+from utils.throttle import RetryPolicy
+from utils.sessions import get_session
+
+
+# Characters of CKAN's responses kept in error messages
+MAX_ERROR_LENGTH = 500
+# GTFS columns which are text, even if their values look like numbers
+# (ids, codes and names such as stop_code or route_short_name)
+TEXT_FIELD_SUFFIXES = ('_id', '_code', '_name')
 
 
 class Connector(object):
     """ Connector to fetch GTFS data from OST API and put on CKAN """
 
-    def __init__(self):
+    def __init__(self, session=None, ost_session=None, geocache=None,
+                 boundaries=None, geocoders=None, deferred=None):
         self.ckan = CkanClient(CKAN_HOST, CKAN_API_KEY)
+        # Keep-alive connections to CKAN and to OST
+        self.session = session or get_session(CKAN_HOST)
+        self.ost_session = ost_session or get_session(OST_API_MAIN_URL)
+        # Loaded when first used, as most tasks need none of them:
+        # addresses of the coordinates geocoded by previous runs,
+        self._geocache = geocache
+        # reverse geocoders, queried concurrently,
+        self._geocoders = geocoders
+        # Places waiting for an address
+        self._deferred = deferred
+        # and parishes' boundaries (None to ask OST's whereat instead)
+        self._boundaries = boundaries
+        self._boundaries_loaded = boundaries is not None
+        # Failed DataStore batches are retried on these errors
+        self.retry_policy = RetryPolicy(CKAN_RETRIES)
         self.places_list = []
         self.cp_stops = []
         self.carris_stops = []
 
-    @staticmethod
-    def fetch_full_gtfs():
+    @property
+    def geocache(self):
+        if self._geocache is None:
+            self._geocache = GeocodeCache()
+        return self._geocache
+
+    @property
+    def geocoders(self):
+        if self._geocoders is None:
+            self._geocoders = get_geocoder_pool(self.geocache)
+        return self._geocoders
+
+    @property
+    def deferred(self):
+        if self._deferred is None:
+            self._deferred = DeferredPlaces()
+        return self._deferred
+
+    @property
+    def boundaries(self):
+        if not self._boundaries_loaded:
+            self._boundaries = load_boundaries()
+            self._boundaries_loaded = True
+        return self._boundaries
+
+    def fetch_gtfs(self, parameter):
         """
-          Fetches the GTFS zip file from OST into the data folder,
-          extracts the .txt files from the ZIP and removes the archive.
+          Fetches a publisher's GTFS zip file from OST into its
+          data folder, checks it and extracts the .txt files.
+        """
+        api_url = get_ost_api(
+            api=OST_API_MAIN_URL,
+            model_name='gtfs',
+            api_key=OST_API_KEY,
+            params=parameter,
+        )
+        # Data folder is created if it doesn't exist
+        dataset_name = DATASETS_NAMES[parameter['publisher_name']]
+        data_folder = ''.join([CKAN_PWD, dataset_name, '/'])
+        zip_path = os.path.join(data_folder, 'gtfs.zip')
+        if not os.path.exists(data_folder):
+            os.makedirs(data_folder)
+        try:
+            download(api_url, zip_path, session=self.ost_session)
+            check_zip(zip_path)
+        except (IOError, RequestException) as error:
+            error = {
+                '__type': 'GTFS download',
+                'name': str(error) or error.__class__.__name__,
+            }
+            raise CKANError(get_ckan_error(error, parameter['publisher_name']))
+        with ZipFile(zip_path, 'r') as gtfs_zip:
+            gtfs_zip.extractall(data_folder)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+    def fetch_full_gtfs(self):
+        """
+          Fetches the GTFS zip files of every publisher from OST
+          at the same time (streaming them to disk), extracts the
+          .txt files from the ZIPs and removes the archives.
         """
         api_params = (
             OST_GTFS_PARAMS_CARRIS,
             OST_GTFS_PARAMS_CP,
         )
-        for parameter in api_params:
-            api_url = get_ost_api(
-                api=OST_API_MAIN_URL,
-                model_name='gtfs',
-                api_key=OST_API_KEY,
-                params=parameter,
-            )
-            # Data folder is created if it doesn't exist
-            dataset_name = DATASETS_NAMES[parameter['publisher_name']]
-            data_folder = ''.join([CKAN_PWD, dataset_name, '/'])
-            zip_path = os.path.join(data_folder, 'gtfs.zip')
-            if not os.path.exists(data_folder):
-                os.makedirs(data_folder)
-            command = 'curl --silent \'{url}\' >> {data_dir}'.format(
-                url=api_url, data_dir=zip_path,
-            )
-            # Check if curl command runs well
-            return_value = os.system(command)
-            if return_value > 0:
-                error = {
-                    '__type': ['curl'],
-                    'name': ['command not found. Please see docs for details'],
-                }
-                raise CKANError(get_ckan_error(error, ''))
-            with ZipFile(zip_path, 'r') as gtfs_zip:
-                gtfs_zip.extractall(data_folder)
-            if os.path.exists(zip_path):
-                os.remove(zip_path)
+        pool = ThreadPool(len(api_params))
+        try:
+            pool.map(self.fetch_gtfs, api_params)
+        finally:
+            pool.terminate()
+            pool.join()
 
     def fetch_gtfs_stops(self):
         """
           Fetches the GTFS Stops of the given agencies
         """
-        crawler = Crawler()
+        crawler = Crawler(session=self.ost_session)
         cp_id = crawler.get_agency(CP_NAME).get('id')
         carris_id = crawler.get_agency(CARRIS_NAME).get('id')
         # Get stops contained in Lisbon district
@@ -181,12 +258,12 @@ class Connector(object):
                 ckan_type='resource',
                 ckan_action='create',
             )
-            response = requests.post(
+            response = self.session.post(
                 api,
-                data=json.dumps(resource),
+                data=dumps(resource),
                 headers=CKAN_AUTH,
             )
-            resource = json.loads(response.content)
+            resource = loads(response.content)
             if response.status_code != 200 or resource.get('success') is False:
                 return None
         except CkanAccessDenied:
@@ -209,21 +286,20 @@ class Connector(object):
     @staticmethod
     def get_gtfs_resources(dataset):
         """
-          Parses GTFS .txt files and returns a dictionary with all of them
-            * dataset_resources - dictionary where key is filename and value
-              is list of dictionaries (key = attribute name, value = attribute)
+          Returns the (filename, path) of the dataset's GTFS .txt
+          files which have at least one row, without reading them
         """
-        dataset_resources = {}
+        dataset_resources = []
         for filename in sorted(GTFS_RESOURCES):
-            resources = []
             array = [CKAN_PWD, dataset['name'], '/', filename, GTFS_EXTENSION]
             curr_file = ''.join(array)
+            if not os.path.exists(curr_file):
+                continue
             with open(curr_file, 'r') as csv_file:
-                reader = csv.DictReader(csv_file)
-                for row in reader:
-                    resources.append(row)
-            if resources:
-                dataset_resources[filename] = resources
+                # Header and first row
+                has_rows = csv_file.readline() and csv_file.readline()
+            if has_rows:
+                dataset_resources.append((filename, curr_file))
         return dataset_resources
 
     def get_resources_names(self, dataset):
@@ -238,25 +314,101 @@ class Connector(object):
         return names
 
     @staticmethod
-    def get_fields(resource_list):
+    def get_fields(rows, fieldnames):
         """
-          Returns a list of dictionaries with every field name and type:
+          Returns a list of dictionaries with every field name and type,
+          inferred from every row (any iterable, read once). Columns
+          whose values are all numbers are 'numeric', unless a value
+          has leading zeros; GTFS ids, codes and names (e.g. stop_code,
+          route_short_name) are always text:
           [
             {
               'id': 'x',
-              'type: 'float',
+              'type: 'numeric',
             },
             {
               'id': 'name',
-              'type': 'string',
+              'type': 'text',
             }
           ]
         """
-        fields = []
-        for attr_name, attr_value in resource_list.iteritems():
-            field_type = get_string_type(attr_value)
-            fields.append({'id': attr_name, 'type': field_type})
-        return fields
+        def is_number(value):
+            digits = value.lstrip('+-')
+            if digits[:1] == '0' and digits[1:2].isdigit():
+                return False
+            return get_string_type(value) != 'string'
+
+        numeric = {attr_name for attr_name in fieldnames
+                   if not attr_name.endswith(TEXT_FIELD_SUFFIXES)}
+        found = set()
+        for row in rows:
+            if not numeric:
+                # Every column is text, no need to read on
+                break
+            for attr_name in list(numeric):
+                value = row.get(attr_name)
+                if value:
+                    found.add(attr_name)
+                    if not is_number(value):
+                        numeric.discard(attr_name)
+        return [{
+            'id': attr_name,
+            'type': 'numeric' if attr_name in numeric & found else 'text',
+        } for attr_name in fieldnames]
+
+    def load_gtfs_file(self, resource_id, path):
+        """
+          Streams a GTFS .txt file into a resource's DataStore, replacing
+          its records. It's read twice: first to infer the field types
+          from every row, before the table is replaced, then to insert
+          the rows in batches, so memory doesn't grow with the file.
+          Prints the progress as the rows are inserted.
+        """
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        progress = {'bytes': 0, 'reported': 0}
+
+        def read_lines(csv_file, report=True):
+            for index, line in enumerate(csv_file):
+                if index == 0 and line.startswith(BOM_UTF8):
+                    line = line[len(BOM_UTF8):]
+                if report:
+                    progress['bytes'] += len(line)
+                    percent = progress['bytes'] * 100 / size
+                    if percent >= progress['reported'] + 10:
+                        progress['reported'] = percent
+                        print '- {}: {}% of {:.1f}MB'.format(
+                            name,
+                            percent,
+                            size / 1e6,
+                        )
+                yield line
+
+        with open(path, 'r') as csv_file:
+            reader = csv.DictReader(read_lines(csv_file, report=False))
+            fields = self.get_fields(reader, reader.fieldnames)
+        numeric = [field['id'] for field in fields
+                   if field['type'] != 'text']
+        with open(path, 'r') as csv_file:
+            reader = csv.DictReader(read_lines(csv_file))
+
+            def get_records():
+                for row in reader:
+                    # Empty numbers are NULLs
+                    for field in numeric:
+                        if not row.get(field):
+                            row[field] = None
+                    yield row
+
+            self.delete_datastore(resource_id)
+            self.create_datastore(resource_id, fields)
+            inserted = self.upsert_records(
+                resource_id,
+                get_records(),
+                method='insert',
+            )
+        print '- {}: {} rows imported'.format(name, inserted)
+        return inserted
 
     @staticmethod
     def remove_files(dataset):
@@ -270,137 +422,384 @@ class Connector(object):
             os.remove(os.path.join(gtfs_dir, txt_file))
 
     @staticmethod
-    def push_stops_to_ckan(stops_list, is_cp, resource_id):
-        """ Pushes OST's GTFS Stops to CKAN Datastore in chunks of five """
-        geolocators = []
-        geolocator_index = 0
-        geolocators.append(GoogleV3())
-        geolocators.append(Nominatim())
+    def get_coords(stop):
+        """ Returns the (latitude, longitude) of an OST stop """
+        return (
+            stop['point']['coordinates'][1],
+            stop['point']['coordinates'][0],
+        )
+
+    def get_whereat(self, coords):
+        """
+          Asks OST's whereat for the parish and municipality of
+          (latitude, longitude). Returns ({}, {}) if it can't tell.
+        """
+        coords_str = ','.join((str(coords[1]), str(coords[0])))
+        api_url = get_ost_api(
+            api=OST_API_MAIN_URL,
+            model_name='whereat',
+            api_key=OST_API_KEY,
+            params={'coords': coords_str},
+        )
+        whereat = self.ost_session.get(api_url)
+        if whereat.status_code == 200:
+            whereat = loads(whereat.content)
+        else:
+            whereat = {}
+        return whereat.get('parish', {}), whereat.get('municipality', {})
+
+    def locate_stops(self, stops_list):
+        """
+          Finds the parish and municipality of each stop in the local
+          boundaries, returning them by stop id. Stops outside of them
+          (or every stop, without CAOP_BOUNDARIES) get ({}, {}) and
+          are looked up with whereat instead.
+        """
+        stops = [stop for stop in stops_list if stop]
+        if self.boundaries is None:
+            return {stop['id']: ({}, {}) for stop in stops}
+        start_time = time.time()
+        located = self.boundaries.locate_many(
+            [self.get_coords(stop) for stop in stops],
+        )
+        neighbourhoods = dict(zip([stop['id'] for stop in stops], located))
+        print '- Located {} of {} stops in {:.3f}s'.format(
+            sum(1 for parish, _ in located if parish),
+            len(stops),
+            time.time() - start_time,
+        )
+        return neighbourhoods
+
+    def geocode_stops(self, stops_list):
+        """
+          Finds the address of each stop, returning them by stop id
+          (None when no geocoder knows it). Stops that aren't cached
+          are reverse geocoded concurrently by every geocoder.
+        """
+        addresses = {}
+        missing = []
+        for stop in stops_list:
+            if stop:
+                coords = self.get_coords(stop)
+                addresses[stop['id']] = self.geocache.get(coords)
+                if addresses[stop['id']] is None:
+                    missing.append((stop['id'], coords))
+        if not missing:
+            return addresses
+        start_time = time.time()
+        geocoded = self.geocoders.reverse_many(
+            [coords for _, coords in missing],
+        )
+        for (stop_id, coords), (address, provider) in zip(missing, geocoded):
+            if address:
+                self.geocache.set(coords, address, provider)
+            addresses[stop_id] = address
+        print '- Geocoded {} of {} stops in {:.1f}s'.format(
+            sum(1 for address, _ in geocoded if address),
+            len(missing),
+            time.time() - start_time,
+        )
+        print self.geocoders.report()
+        return addresses
+
+    def push_stops_to_ckan(self, stops_list, is_cp, resource_id,
+                           fields=None):
+        """
+          Pushes OST's GTFS Stops to CKAN Datastore as Places: the
+          table is created once (with `fields`, if it's new), then
+          they're upserted in batches
+        """
         # Needed variables for the places' description
         agency_name = CP_NAME if is_cp else CARRIS_NAME
         transport = TRAIN if is_cp else BUS
         agency_url = CP_URL if is_cp else CARRIS_URL
         print '\n- Started importing stops from {}'.format(agency_name)
+        # Parishes/municipalities and addresses of every stop, in batches
+        neighbourhoods = self.locate_stops(stops_list)
+        addresses = self.geocode_stops(stops_list)
+        resolved = []
+        deferred = []
+        stop_places = []
+        belem_tuple = (u'Santa Maria de Belém', u'São Francisco Xavier')
+        for stop in stops_list:
+            place = {}
+            coords = self.get_coords(stop)
+            parish, municipality = neighbourhoods[stop['id']]
+            if not parish:
+                parish, municipality = self.get_whereat(coords)
+            address = addresses[stop['id']]
+            place_name = capwords(stop['stop_name'])
+            body = PLACE_BODY.format(
+                agency_name, transport, place_name.encode('utf-8'),
+            )
+            # The Place, as a DataStore record
+            place['field_poi_id'] = stop['id']
+            place['field_title'] = place_name
+            place['field_category_places'] = TRANSPORTATION_CATEGORY
+            place['field_body'] = body
+            place['field_photographs'] = ""
+            place['field_website'] = agency_url
+            place['field_email'] = ""
+            place['field_phone'] = ""
+            place['field_location_latitude'] = coords[0]
+            place['field_location_longitude'] = coords[1]
+            if parish:
+                neighbourhood = parish.get('name', '')
+                if neighbourhood in belem_tuple:
+                    neighbourhood = 'Belém'
+                place['field_neighbourhood'] = neighbourhood
+            else:
+                place['field_neighbourhood'] = ''
+            if address:
+                address = self.clean_address(address)
+                resolved.append(stop['id'])
+            else:
+                # Patched by resolve_deferred_places later on
+                address = UNKNOWN_ADDRESS
+                deferred.append((stop['id'], coords))
+            place['field_location_address_first_line'] = address
+            place['field_location_address_second_line'] = ''
+            if municipality:
+                municipality_name = municipality.get('name', '')
+                place['field_location_city'] = municipality_name
+            else:
+                place['field_location_city'] = ''
+            place['field_location_country'] = 'Portugal'
+            stop_places.append(place)
+        print '- Geocoding cache: {}'.format(self.geocache.report())
+        self.deferred.remove(resource_id, resolved)
+        self.deferred.add(resource_id, deferred)
+        print '- {} stops without an address, {} Places deferred'.format(
+            len(deferred),
+            self.deferred.count(),
+        )
+        self.create_datastore(
+            resource_id,
+            fields,
+            primary_key=PLACES_PRIMARY_KEY,
+        )
+        self.upsert_records(resource_id, stop_places)
+
+    def create_datastore(self, resource_id, fields=None, primary_key=None):
+        """
+          Creates (or updates) a resource's DataStore table, with its
+          fields, primary key and index, without any records. Fields
+          are only for new tables: CKAN rejects those of an existing
+          one unless they're sent in its own order.
+        """
         api = get_ckan_api(
             ckan_host=CKAN_HOST,
             ckan_type='datastore',
-            ckan_action='create',  # 'upsert',
+            ckan_action='create',
         )
-        geolocator = geolocators[geolocator_index]
-        for stop_group in grouper(stops_list, 5):
-            stop_places = []
-            belem_tuple = (u'Santa Maria de Belém', u'São Francisco Xavier')
-            for stop in stop_group:
-                location = None
-                is_able_to_continue = False
-                if stop:
-                    place = {}
-                    coords = (
-                        stop['point']['coordinates'][1],
-                        stop['point']['coordinates'][0],
-                    )
-                    coords_str = ','.join((str(coords[1]), str(coords[0])))
-                    api_url = get_ost_api(
-                        api=OST_API_MAIN_URL,
-                        model_name='whereat',
-                        api_key=OST_API_KEY,
-                        params={'coords': coords_str},
-                    )
-                    # Get the parish/neighbourhood from OST
-                    whereat = requests.get(api_url)
-                    if whereat.status_code == 200:
-                        whereat = json.loads(whereat.content)
-                    else:
-                        whereat = {}
-                    parish = whereat.get('parish', {})
-                    municipality = whereat.get('municipality', {})
-                    # Get the Address from coordinates with GoogleMaps API
-                    while is_able_to_continue is False:
-                        try:
-                            location = geolocator.reverse(
-                                coords,
-                                exactly_one=True,
-                                timeout=60,
-                            )
-                            is_able_to_continue = True
-                        except GeocoderTimedOut as e:
-                            print '>>>>>>>>>>>>>>> GeocoderTimedOut\n', e
-                            location = None
-                            print 'Moving on...\n\n'
-                        except GeocoderQuotaExceeded as e:
-                            print '>>>>>>>>>>>>>>> GeocoderQuotaExceeded\n', e
-                            geolocator_index += 1
-                            if geolocator_index < len(geolocators):
-                                geolocator = geolocators[geolocator_index]
-                                debug = 'Trying a new geocoder: {}...\n\n'
-                                print debug.format(type(geolocator).__name__)
-                            else:
-                                geolocator_index = 0
-                                geolocator = geolocators[geolocator_index]
-                                break
-                        except GeocoderServiceError as e:
-                            print '\n\n>>>>>>>> Geocoder Service Error:', e
-                            time.sleep(30)
-                    place_name = capwords(stop['stop_name'])
-                    body = PLACE_BODY.format(
-                        agency_name, transport, place_name.encode('utf-8'),
-                    )
-                    # Create a JSON list to be written to file
-                    place['field_poi_id'] = stop['id']
-                    place['field_title'] = place_name
-                    place['field_category_places'] = TRANSPORTATION_CATEGORY
-                    place['field_body'] = body
-                    place['field_photographs'] = ""
-                    place['field_website'] = agency_url
-                    place['field_email'] = ""
-                    place['field_phone'] = ""
-                    place['field_location_latitude'] = coords[0]
-                    place['field_location_longitude'] = coords[1]
-                    if parish:
-                        neighbourhood = parish.get('name', '')
-                        if neighbourhood in belem_tuple:
-                            neighbourhood = 'Belém'
-                        place['field_neighbourhood'] = neighbourhood
-                    else:
-                        place['field_neighbourhood'] = ''
-                    if location:
-                        address = location.address
-                        address = address.replace('&', 'E').replace(';', ' ')
-                        place['field_location_address_first_line'] = address
-                    else:
-                        input_str = '\"No Location for {}. Please enter it: \"'
-                        subprocess.call(['say', input_str])
-                        input_str = input_str.format(coords)
-                        address = raw_input(input_str)
-                        print 'You entered', address
-                        address = address.replace('&', 'E').replace(';', ' ')
-                        place['field_location_address_first_line'] = address
-                    place['field_location_address_second_line'] = ''
-                    if municipality:
-                        municipality_name = municipality.get('name', '')
-                        place['field_location_city'] = municipality_name
-                    else:
-                        place['field_location_city'] = ''
-                    place['field_location_country'] = 'Portugal'
-                    place['resource_id'] = resource_id
-                    stop_places.append(place)
-            records = {
-                'resource_id': resource_id,
-                'primary_key': ['field_poi_id'],
-                'indexes': ['field_poi_id'],
-                'records': stop_places,
-                'force': True,
+        schema = {
+            'resource_id': resource_id,
+            'force': True,
+        }
+        if fields:
+            schema['fields'] = fields
+        if primary_key:
+            schema['primary_key'] = [primary_key]
+            schema['indexes'] = [primary_key]
+        response = self.session.post(
+            api,
+            data=dumps(schema),
+            headers=CKAN_AUTH,
+        )
+        if response.status_code != 200:
+            error = {
+                '__type': 'DataStore create',
+                'name': response.content[:MAX_ERROR_LENGTH],
             }
-            # print records
-            response = requests.post(
-                api,
-                data=json.dumps(records),
-                headers=CKAN_AUTH,
+            raise CKANError(get_ckan_error(error, api))
+
+    def delete_datastore(self, resource_id):
+        """ Deletes a resource's DataStore table, if there's one """
+        api = get_ckan_api(
+            ckan_host=CKAN_HOST,
+            ckan_type='datastore',
+            ckan_action='delete',
+        )
+        response = self.session.post(
+            api,
+            data=dumps({'resource_id': resource_id, 'force': True}),
+            headers=CKAN_AUTH,
+        )
+        if response.status_code not in (200, 404):
+            error = {
+                '__type': 'DataStore delete',
+                'name': response.content[:MAX_ERROR_LENGTH],
+            }
+            raise CKANError(get_ckan_error(error, api))
+
+    def post_records(self, api, resource_id, batch, method='upsert'):
+        """
+          Posts a batch of records (already serialized) with one
+          datastore_upsert request, retrying connection and server
+          errors. Returns the number of records and the error, if any.
+        """
+        payload = '{{"resource_id":{},"method":{},"force":true,' \
+            '"records":[{}]}}'.format(
+                dumps(resource_id),
+                dumps(method),
+                ','.join(batch),
             )
-            print "\n", response.content.encode('utf-8', 'replace'), "\n"
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(
+                    api,
+                    data=payload,
+                    headers=CKAN_AUTH,
+                )
+                if response.status_code == 200:
+                    return len(batch), None
+                error_class = 'server' if response.status_code >= 500 \
+                    else 'client'
+                error = 'HTTP {} - {}'.format(
+                    response.status_code,
+                    response.content[:MAX_ERROR_LENGTH],
+                )
+            except RequestException as exception:
+                error_class = 'connection'
+                error = str(exception) or exception.__class__.__name__
+            attempt += 1
+            if not self.retry_policy.should_retry(error_class, attempt):
+                return len(batch), error
+            time.sleep(self.retry_policy.get_delay(attempt))
+
+    def upsert_records(self, resource_id, records, method='upsert',
+                       batch_size=CKAN_BATCH_SIZE,
+                       max_bytes=CKAN_BATCH_BYTES, workers=CKAN_WORKERS):
+        """
+          Upserts records (any iterable) into a resource's DataStore in
+          batches of up to batch_size records and max_bytes of payload,
+          with up to `workers` requests in flight. A failed batch doesn't
+          stop the others: CKANError is raised at the end if any failed.
+          Returns the number of records upserted.
+        """
+        api = get_ckan_api(
+            ckan_host=CKAN_HOST,
+            ckan_type='datastore',
+            ckan_action='upsert',
+        )
+        serialized = (dumps(record) for record in records)
+        post_batch = partial(
+            self.post_records,
+            api,
+            resource_id,
+            method=method,
+        )
+        started_at = time.time()
+        upserted, errors = 0, []
+        results = imap_bounded(
+            post_batch,
+            batches(serialized, batch_size, max_bytes),
+            workers,
+        )
+        for batch_records, error in results:
+            if error:
+                errors.append(error)
+            else:
+                upserted += batch_records
+        elapsed = time.time() - started_at
+        print '- {}: {} records in {:.1f}s ({:.0f} records/s)'.format(
+            method,
+            upserted,
+            elapsed,
+            upserted / elapsed if elapsed else 0.0,
+        )
+        if errors:
+            error = {
+                '__type': 'DataStore {}'.format(method),
+                'name': '{} batches failed, first: {}'.format(
+                    len(errors),
+                    errors[0],
+                ),
+            }
+            raise CKANError(get_ckan_error(error, api))
+        return upserted
+
+    @staticmethod
+    def clean_address(address):
+        """ Removes the characters CKAN's DataStore chokes on """
+        return address.replace('&', 'E').replace(';', ' ')
+
+    def resolve_deferred_places(self, limit=DEFERRED_BATCH):
+        """
+          Geocodes up to `limit` Places imported without an address
+          and patches them in the DataStore. The ones still unknown
+          stay queued for the next time.
+        """
+        pending = self.deferred.get_pending(limit)
+        if not pending:
+            return 0
+        geocoded = self.geocoders.reverse_many(
+            [coords for _, _, coords in pending],
+        )
+        resources = {}
+        for (resource_id, poi_id, coords), (address, provider) in \
+                zip(pending, geocoded):
+            found, missing = resources.setdefault(resource_id, ([], []))
+            if address:
+                self.geocache.set(coords, address, provider)
+                found.append((poi_id, self.clean_address(address)))
+            else:
+                missing.append(poi_id)
+        patched = 0
+        for resource_id, (found, missing) in resources.iteritems():
+            self.deferred.record_attempt(resource_id, missing)
+            if not found:
+                continue
+            records = [{
+                PLACES_PRIMARY_KEY: int(poi_id),
+                'field_location_address_first_line': address,
+            } for poi_id, address in found]
+            poi_ids = [poi_id for poi_id, _ in found]
+            try:
+                patched += self.upsert_records(
+                    resource_id,
+                    records,
+                    method='update',
+                )
+            except CKANError as error:
+                # Patched again next time, updating is idempotent
+                print '\n\n>>>>>>>>>>>> ERROR', error.message
+                self.deferred.record_attempt(resource_id, poi_ids)
+            else:
+                self.deferred.remove(resource_id, poi_ids)
+        print '- Patched {} of {} deferred Places, {} still deferred'.format(
+            patched,
+            len(pending),
+            self.deferred.count(),
+        )
+        return patched
+
+    def warm_geocode_cache(self, resource_id, limit=5000):
+        """
+          Seeds the geocoding cache with the addresses of the
+          Places already in the DataStore (imported by previous runs)
+        """
+        api = get_ckan_api(
+            ckan_host=CKAN_HOST,
+            ckan_type='datastore',
+            ckan_action='search',
+        )
+        offset = 0
+        while True:
+            params = {
+                'resource_id': resource_id,
+                'limit': limit,
+                'offset': offset,
+            }
+            response = self.session.get(api, params=params)
             if response.status_code != 200:
-                print "\n\n>>>>>>>>>>>> ERROR"
-                print records
+                break
+            records = loads(response.content)['result']['records']
+            self.geocache.warm(records)
+            if len(records) < limit:
+                break
+            offset += limit
 
     def push_to_ckan(self, gtfs_csv=False):
         """
@@ -425,16 +824,11 @@ class Connector(object):
                     resources_names = self.get_resources_names(each)
                     # Routine to import the entire GTFS to CKAN
                     gtfs_resources = self.get_gtfs_resources(each)
-                    for name, resource_list in gtfs_resources.iteritems():
+                    for name, path in gtfs_resources:
                         if name not in resources_names:
                             self.create_resource(name, each)
                         resource = self.get_resource(name, each)
-                        upload_resource_to_datastore(
-                            resource=resource,
-                            if_changed=False,
-                            locally_cache_content=False,
-                            ckan=self.ckan,
-                        )
+                        self.load_gtfs_file(resource['id'], path)
                     self.remove_files(each)
         else:
             try:
@@ -455,45 +849,146 @@ class Connector(object):
                     )
                 resource = self.get_resource(CKAN_RESOURCE_NAME, dataset)
                 resource_id = resource.get('id')
-                self.push_stops_to_ckan(self.cp_stops, True, resource_id)
-                self.push_stops_to_ckan(self.carris_stops, False, resource_id)
+                if GEOCODE_CACHE_WARM and \
+                        CKAN_RESOURCE_NAME in resources_names:
+                    self.warm_geocode_cache(resource_id)
+                # Tables created by older runs keep their fields
+                fields = None if resource.get('datastore_active') \
+                    else CKAN_DATASET_FIELDS
+                agencies = ((self.cp_stops, True), (self.carris_stops, False))
+                for stops_list, is_cp in agencies:
+                    try:
+                        self.push_stops_to_ckan(
+                            stops_list,
+                            is_cp,
+                            resource_id,
+                            fields,
+                        )
+                    except CKANError as error:
+                        # The other agency's stops are pushed anyway
+                        print '\n\n>>>>>>>>>>>> ERROR ({}) {}'.format(
+                            CP_NAME if is_cp else CARRIS_NAME,
+                            error.message,
+                        )
 
-    def pull_from_ckan(self):
+    def dump_resource(self, resource_id, file_path):
         """
-          Main routine that imports GTFS back to One.Stop.Transport
+          Streams a resource's records into a CSV file with CKAN's
+          DataStore dump endpoint, without its _id column. Returns
+          False if the endpoint isn't available or the dump fails.
+        """
+        api = get_ckan_api(
+            ckan_host=CKAN_HOST,
+            ckan_type='datastore',
+            ckan_action='dump',
+        ) + resource_id
+        part_path = file_path + PART_SUFFIX
+        try:
+            response = self.session.get(api, stream=True)
+        except RequestException:
+            return False
+        completed = False
+        try:
+            content_type = response.headers.get('content-type', '')
+            if response.status_code != 200 or 'csv' not in content_type:
+                return False
+            lines = response.iter_lines(DOWNLOAD_CHUNK_SIZE)
+            with open(part_path, 'w') as output_file:
+                writer = csv.writer(output_file, lineterminator='\n')
+                reader = csv.reader(lines)
+                header = next(reader, None)
+                if header is None:
+                    return False
+                header[0] = header[0].replace(BOM_UTF8, '')
+                columns = [index for index, column in enumerate(header)
+                           if column != '_id']
+                for row in chain([header], reader):
+                    writer.writerow([row[index] for index in columns])
+            completed = True
+        except (RequestException, csv.Error):
+            return False
+        finally:
+            response.close()
+            if not completed and os.path.exists(part_path):
+                os.remove(part_path)
+        os.rename(part_path, file_path)
+        return True
+
+    def search_page(self, resource_id, offset, limit=CKAN_EXPORT_PAGE_SIZE):
+        """ Returns a datastore_search page of a resource's records """
+        api = get_ckan_api(
+            ckan_host=CKAN_HOST,
+            ckan_type='datastore',
+            ckan_action='search',
+        )
+        params = {
+            'resource_id': resource_id,
+            'limit': limit,
+            'offset': offset,
+            # A stable order, so that pages don't overlap
+            'sort': '_id',
+        }
+        response = self.session.get(url=api, params=params)
+        if response.status_code != 200:
+            error = {
+                '__type': 'DataStore search',
+                'name': response.content[:MAX_ERROR_LENGTH],
+            }
+            raise CKANError(get_ckan_error(error, api))
+        return loads(response.content)['result']
+
+    def search_resource(self, resource_id, file_path,
+                        limit=CKAN_EXPORT_PAGE_SIZE, workers=CKAN_WORKERS):
+        """
+          Streams a resource's records into a CSV file with
+          datastore_search: the first page tells the fields (the
+          CSV's columns, sorted) and total, the other pages are fetched
+          `workers` at a time and written in order as they arrive.
+          Nested values (json fields) are written as JSON.
+        """
+        first_page = self.search_page(resource_id, 0, limit)
+        schema = sorted((field['id'], (field['id'],))
+                        for field in first_page['fields']
+                        if field['id'] != '_id')
+        get_page = lambda offset: self.search_page(resource_id, offset, limit)
+        pages = imap_bounded(
+            get_page,
+            xrange(limit, first_page.get('total', 0), limit),
+            workers,
+        )
+        with open(file_path, 'w') as output_file:
+            writer = CSVWriter(output_file)
+            writer.write_header(schema)
+            for page in chain([first_page], pages):
+                writer.write_records(page['records'])
+
+    def export_resource(self, resource):
+        """
+          Exports a resource's DataStore records to its GTFS file,
+          with the dump endpoint if CKAN has it (or datastore_search)
+        """
+        file_path = resource['url'].replace('file://', '')
+        started_at = time.time()
+        if not self.dump_resource(resource['id'], file_path):
+            self.search_resource(resource['id'], file_path)
+        return file_path, time.time() - started_at
+
+    def pull_from_ckan(self, workers=CKAN_EXPORT_WORKERS):
+        """
+          Main routine that imports GTFS back to One.Stop.Transport:
+          each dataset's resources are exported at the same time
+          (up to `workers`), zipped and uploaded to OST
         """
-        # TODO split this several functions
-        limit = 5000
         datasets = (CKAN_CARRIS_DATASET, CKAN_CP_DATASET)
         for each in datasets:
             dataset = self.get_dataset(each)
-            for resource in dataset['resources']:
-                file_path = resource['url'].replace('file://', '')
-                print '\n', file_path
-                has_next = True
-                offset = 0
-                api = get_ckan_api(
-                    ckan_host=CKAN_HOST,
-                    ckan_type='datastore',
-                    ckan_action='search',
-                )
-                json_dict = []
-                while has_next:
-                    params = {
-                        'resource_id': resource['id'],
-                        'limit': limit,
-                        'offset': offset,
-                    }
-                    response = requests.get(url=api, params=params)
-                    if response.status_code == 200:
-                        # Convert the content to array of dicts
-                        json_resp = json.loads(response.content)
-                        json_data = json_resp['result']['records']
-                        json_dict.extend([dict(to_keyval(obj)) for obj in json_data])
-                        # Write to file
-                        has_next = len(json_data) >= limit
-                        offset += limit
-                json_to_csv(json_dict, file_path)
+            exported = imap_bounded(
+                self.export_resource,
+                dataset['resources'],
+                workers,
+            )
+            for file_path, elapsed in exported:
+                print '\n', file_path, '({:.1f}s)'.format(elapsed)
             # Zip everything into a file
             data_folder = ''.join([CKAN_PWD, dataset['name'], '/'])
             zip_path = os.path.join(data_folder, 'gtfs.zip')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+import sqlite3
+import time
+from threading import RLock
+
+from utils.constants import DEFERRED_PLACES
+
+
+class DeferredPlaces(object):
+    """
+      Persistent queue of the Places imported without an address
+      (no geocoder knew it), which are patched in the DataStore
+      once one does, instead of asking someone to type it in.
+    """
+
+    def __init__(self, path=DEFERRED_PLACES):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(
+            path,
+            timeout=60,
+            check_same_thread=False,
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS places ('
+            'resource_id TEXT, poi_id TEXT, latitude REAL, longitude REAL, '
+            'attempts INTEGER, added_at REAL, '
+            'PRIMARY KEY (resource_id, poi_id))'
+        )
+        self.connection.commit()
+        self.lock = RLock()
+
+    def add(self, resource_id, places):
+        """
+          Queues (poi_id, (latitude, longitude)) Places of a resource,
+          keeping the attempts of the ones already queued.
+        """
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO places VALUES (?, ?, ?, ?, 0, ?)',
+                [(resource_id, unicode(poi_id), coords[0], coords[1],
+                  time.time()) for poi_id, coords in places],
+            )
+            self.connection.commit()
+
+    def remove(self, resource_id, poi_ids):
+        """ Removes Places of a resource which have an address now """
+        with self.lock:
+            self.connection.executemany(
+                'DELETE FROM places WHERE resource_id = ? AND poi_id = ?',
+                [(resource_id, unicode(poi_id)) for poi_id in poi_ids],
+            )
+            self.connection.commit()
+
+    def get_pending(self, limit):
+        """
+          Returns up to `limit` queued Places as (resource_id, poi_id,
+          (latitude, longitude)), the least attempted ones first.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT resource_id, poi_id, latitude, longitude '
+                'FROM places ORDER BY attempts, added_at LIMIT ?',
+                (limit,),
+            ).fetchall()
+        return [(resource_id, poi_id, (latitude, longitude))
+                for resource_id, poi_id, latitude, longitude in rows]
+
+    def record_attempt(self, resource_id, poi_ids):
+        """ Counts a failed attempt to find the Places' addresses """
+        with self.lock:
+            self.connection.executemany(
+                'UPDATE places SET attempts = attempts + 1 '
+                'WHERE resource_id = ? AND poi_id = ?',
+                [(resource_id, unicode(poi_id)) for poi_id in poi_ids],
+            )
+            self.connection.commit()
+
+    def count(self):
+        """ Returns how many Places are waiting for an address """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM places',
+            ).fetchone()[0]
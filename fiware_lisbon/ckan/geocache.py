@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+import sqlite3
+import time
+from collections import Counter
+from threading import RLock
+
+from utils.constants import GEOCODE_CACHE
+from utils.constants import GEOCODE_CACHE_TTL
+from utils.constants import GEOCODE_PRECISION
+from utils.constants import UNKNOWN_ADDRESS
+
+
+class GeocodeCache(object):
+    """
+      Persistent cache of reverse geocoded addresses, keyed by the
+      coordinates rounded to `precision` decimals (5 is about 1m),
+      so that stops which didn't move aren't geocoded again.
+      Addresses older than `ttl` seconds are geocoded again.
+      The geocoders' daily requests are counted in it as well.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE, ttl=GEOCODE_CACHE_TTL,
+                 precision=GEOCODE_PRECISION):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(
+            path,
+            timeout=60,
+            check_same_thread=False,
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS addresses ('
+            'key TEXT PRIMARY KEY, address TEXT, provider TEXT, '
+            'updated_at REAL)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS quota ('
+            'provider TEXT, day TEXT, used INTEGER, '
+            'PRIMARY KEY (provider, day))'
+        )
+        self.connection.commit()
+        self.ttl = ttl
+        self.precision = precision
+        # Hits, misses, expired and warmed entries
+        self.stats = Counter()
+        self.lock = RLock()
+
+    def get_key(self, coords):
+        """ Returns the rounded 'latitude,longitude' of the coordinates """
+        return '{0:.{2}f},{1:.{2}f}'.format(
+            float(coords[0]),
+            float(coords[1]),
+            self.precision,
+        )
+
+    def get(self, coords):
+        """ Returns the cached address of the coordinates or None """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT address, updated_at FROM addresses WHERE key = ?',
+                (self.get_key(coords),),
+            ).fetchone()
+            # Placeholders warmed by older runs aren't addresses
+            if row is None or row[0] == UNKNOWN_ADDRESS:
+                self.stats['misses'] += 1
+                return None
+            address, updated_at = row
+            if self.ttl and time.time() - updated_at > self.ttl:
+                self.stats['expired'] += 1
+                return None
+            self.stats['hits'] += 1
+            return address
+
+    def set(self, coords, address, provider):
+        """ Caches the address of the coordinates """
+        if not address or address == UNKNOWN_ADDRESS:
+            return
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)',
+                (self.get_key(coords), address, provider, time.time()),
+            )
+            self.connection.commit()
+
+    def warm(self, places):
+        """
+          Seeds the cache with the addresses of the Places imported
+          by a previous run (CKAN DataStore records), without
+          replacing the ones already cached. Places imported with
+          UNKNOWN_ADDRESS are left out, to be geocoded again.
+        """
+        rows = [(
+            self.get_key((
+                place['field_location_latitude'],
+                place['field_location_longitude'],
+            )),
+            place['field_location_address_first_line'],
+            'previous run',
+            time.time(),
+        ) for place in places
+            if place.get('field_location_address_first_line') and
+            place['field_location_address_first_line'] != UNKNOWN_ADDRESS and
+            place.get('field_location_latitude') is not None and
+            place.get('field_location_longitude') is not None]
+        with self.lock:
+            cursor = self.connection.executemany(
+                'INSERT OR IGNORE INTO addresses VALUES (?, ?, ?, ?)',
+                rows,
+            )
+            self.connection.commit()
+            self.stats['warmed'] += cursor.rowcount
+        return cursor.rowcount
+
+    def get_usage(self, provider, day):
+        """ Returns the requests sent to a provider on a day """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT used FROM quota WHERE provider = ? AND day = ?',
+                (provider, day),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def reserve_usage(self, provider, day, quota=None):
+        """
+          Counts a request to a provider on a day, unless the day's
+          total (including other workers' requests) reached `quota`.
+          Checked and counted in one transaction, so workers sharing
+          the file can't overrun it. Returns (reserved, day's total).
+        """
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO quota VALUES (?, ?, 0)',
+                (provider, day),
+            )
+            cursor = self.connection.execute(
+                'UPDATE quota SET used = used + 1 '
+                'WHERE provider = ? AND day = ? AND (? IS NULL OR used < ?)',
+                (provider, day, quota, quota),
+            )
+            used = self.connection.execute(
+                'SELECT used FROM quota WHERE provider = ? AND day = ?',
+                (provider, day),
+            ).fetchone()[0]
+            self.connection.commit()
+        return cursor.rowcount == 1, used
+
+    def report(self):
+        """ Returns the cache's statistics, to be printed """
+        return '{} hits, {} misses, {} expired, {} warmed'.format(
+            self.stats['hits'],
+            self.stats['misses'],
+            self.stats['expired'],
+            self.stats['warmed'],
+        )
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import time
+from collections import Counter
+from threading import Lock
+
+from geopy.geocoders import GoogleV3
+from geopy.geocoders import Nominatim
+from geopy.exc import GeocoderQuotaExceeded
+from geopy.exc import GeocoderServiceError
+
+from utils.constants import GEOCODER_BREAKER_COOLDOWN
+from utils.constants import GEOCODER_BREAKER_THRESHOLD
+from utils.constants import GEOCODER_WORKERS
+from utils.constants import GOOGLE_GEOCODER_QUOTA
+from utils.constants import GOOGLE_GEOCODER_RATE
+from utils.constants import NOMINATIM_QUOTA
+from utils.constants import NOMINATIM_RATE
+from utils.throttle import CircuitBreaker
+from utils.throttle import TokenBucket
+from utils.utils import imap_bounded
+
+
+class Provider(object):
+    """
+      A reverse geocoder with its own rate limit, quota of requests
+      per day (None or 0 for no quota) and circuit breaker. The day's
+      requests are counted in `usage` (a GeocodeCache), if given, so
+      the quota holds across runs and workers sharing its file.
+    """
+
+    def __init__(self, geocoder, rate, quota=None, usage=None,
+                 breaker=None):
+        self.geocoder = geocoder
+        self.name = type(geocoder).__name__
+        self.bucket = TokenBucket(rate)
+        self.quota = quota or None
+        self.usage = usage
+        self.day = None
+        self.used = 0
+        self.exhausted = False
+        self.breaker = breaker or CircuitBreaker(
+            GEOCODER_BREAKER_THRESHOLD,
+            GEOCODER_BREAKER_COOLDOWN,
+        )
+        # Requests, addresses found, failures and quota errors
+        self.stats = Counter()
+        self.lock = Lock()
+
+    def has_quota(self):
+        """ Checks the day's quota, with self.lock held """
+        day = get_day()
+        if day != self.day:
+            self.day = day
+            self.used = 0
+            if self.usage is not None:
+                self.used = self.usage.get_usage(self.name, day)
+            self.exhausted = False
+        if self.exhausted:
+            return False
+        return self.quota is None or self.used < self.quota
+
+    def is_available(self):
+        """ Checks if the provider has quota left and isn't failing """
+        with self.lock:
+            if not self.has_quota():
+                return False
+        return not self.breaker.is_open()
+
+    def try_acquire(self):
+        """
+          Reserves a request of the day's quota if the provider has
+          any left and isn't failing. Checked and counted at once, so
+          concurrent lookups can't send more requests than the quota.
+        """
+        with self.lock:
+            if not self.has_quota() or self.breaker.is_open():
+                return False
+            if self.usage is None:
+                self.used += 1
+            else:
+                reserved, self.used = self.usage.reserve_usage(
+                    self.name,
+                    self.day,
+                    self.quota,
+                )
+                if not reserved:
+                    return False
+            self.stats['requests'] += 1
+        return True
+
+    def reverse(self, coords):
+        """
+          Returns the address of (latitude, longitude), or None if the
+          provider doesn't know it, once try_acquire() reserved the
+          request. Raises GeocoderServiceError.
+        """
+        self.bucket.acquire()
+        try:
+            location = self.geocoder.reverse(
+                coords,
+                exactly_one=True,
+                timeout=60,
+            )
+        except GeocoderQuotaExceeded:
+            # No more requests until the quota's period is over
+            with self.lock:
+                self.exhausted = True
+                self.stats['quota'] += 1
+            raise
+        except GeocoderServiceError:
+            self.breaker.record_failure()
+            with self.lock:
+                self.stats['failed'] += 1
+            raise
+        self.breaker.record_success()
+        if location is None:
+            return None
+        with self.lock:
+            self.stats['found'] += 1
+        return location.address
+
+    def report(self):
+        """ Returns the provider's statistics, to be printed """
+        if self.breaker.is_open():
+            state = 'failing'
+        elif not self.is_available():
+            state = 'out of quota'
+        else:
+            state = 'available'
+        report = '{}: {} requests, {} found, {} failed, {} over quota ({})'
+        return report.format(
+            self.name,
+            self.stats['requests'],
+            self.stats['found'],
+            self.stats['failed'],
+            self.stats['quota'],
+            state,
+        )
+
+
+class GeocoderPool(object):
+    """
+      Reverse geocodes with several providers at the same time: each
+      lookup goes to the available provider whose rate limit frees up
+      first, and to the next one if it fails or finds nothing, so
+      batches are bounded by the providers' combined throughput.
+    """
+
+    def __init__(self, providers, workers=GEOCODER_WORKERS):
+        self.providers = providers
+        self.workers = workers
+
+    def reverse(self, coords):
+        """
+          Returns the address of (latitude, longitude) and the name
+          of the provider which found it, or (None, None).
+        """
+        tried = set()
+        while True:
+            providers = [provider for provider in self.providers
+                         if provider not in tried and
+                         provider.is_available()]
+            if not providers:
+                return None, None
+            provider = min(
+                providers,
+                key=lambda provider: provider.bucket.get_wait(),
+            )
+            tried.add(provider)
+            if not provider.try_acquire():
+                continue
+            try:
+                address = provider.reverse(coords)
+            except GeocoderServiceError as error:
+                print '>>>>>>>> {} failed: {}'.format(provider.name, error)
+                continue
+            if address:
+                return address, provider.name
+
+    def reverse_many(self, coords_list):
+        """ Batched reverse(), in the same order as coords_list """
+        return list(imap_bounded(self.reverse, coords_list, self.workers))
+
+    def report(self):
+        """ Returns the providers' statistics, to be printed """
+        return '\n'.join(provider.report() for provider in self.providers)
+
+
+def get_day():
+    """ Returns the UTC date, which the quotas are counted by """
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+def get_geocoder_pool(usage=None):
+    """
+      Returns a pool of GoogleV3 and Nominatim, as configured,
+      counting their requests in `usage` (a GeocodeCache)
+    """
+    return GeocoderPool([
+        Provider(
+            GoogleV3(),
+            GOOGLE_GEOCODER_RATE,
+            GOOGLE_GEOCODER_QUOTA,
+            usage,
+        ),
+        Provider(Nominatim(), NOMINATIM_RATE, NOMINATIM_QUOTA, usage),
+    ])
@@ -38,6 +38,19 @@ def transfer_gtfs_ckan(full_gtfs=False):
         print(Fore.RED + str(error) + Fore.RESET + ':' + message)
 
 
+@task(name='resolve_deferred_places', ignore_result=True)
+def resolve_deferred_places():
+    # Patches the Places imported without an address, if any
+    # geocoder knows it by now.
+    try:
+        connector = Connector()
+        connector.resolve_deferred_places()
+    except CKANError as error:
+        message = Fore.RED + str(error) + Fore.RESET + ': ' + \
+            error.message
+        print('\n> ' + message)
+
+
 @task(name='transfer_gtfs_ost', ignore_result=True)
 def transfer_gtfs_ost():
     connector = Connector()
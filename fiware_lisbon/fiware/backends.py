@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import re
+
+from utils.constants import FIWARE_API_VERSION
+from utils.constants import FIWARE_GOOD_STATUS
+from utils.errors import FiWareError
+from utils.codec import dumps
+from utils.codec import loads
+from utils.utils import get_fiware_api
+from serializer import ElementSerializer
+from serializer import KeyValuesSerializer
+
+
+class NGSI10Backend(object):
+    """
+      ContextBroker's NGSI10 API: batches of contextElements sent
+      with updateContext and queried with queryContext
+    """
+    version = 'v1'
+    serializer = ElementSerializer
+    # Key of the entities in FiWare.get_data's result
+    results_key = 'contextResponses'
+    update_params = None
+
+    def __init__(self, host):
+        self.host = host
+
+    def get_url(self, update=False):
+        """ Returns the API URL to query or update entities """
+        return get_fiware_api(self.host, update=update, version=self.version)
+
+    @staticmethod
+    def wrap_batch(elements):
+        """
+          Wraps a list of already serialized contextElements
+          into a single APPEND payload.
+        """
+        return ''.join([
+            '{"contextElements":[',
+            ','.join(elements),
+            '],"updateAction":"APPEND"}',
+        ])
+
+    @staticmethod
+    def get_batch_errors(response, element_ids):
+        """
+          Maps the errors of a batch updateContext back to the ids
+          of the elements which caused them. Returns a list of
+          (element id, error) tuples, empty if all went well.
+        """
+        if response.status_code != 200:
+            return [(each, response.content) for each in element_ids]
+        content = loads(response.content)
+        if 'errorCode' in content:
+            error = dumps(content['errorCode'])
+            return [(each, error) for each in element_ids]
+        errors = []
+        context_responses = content.get('contextResponses', [])
+        for index, context_response in enumerate(context_responses):
+            if context_response['statusCode'] == FIWARE_GOOD_STATUS:
+                continue
+            # Responses have the element's id, else follow the request order
+            element = context_response.get('contextElement', {})
+            element_id = element.get('id', element_ids[index])
+            error = dumps(context_response['statusCode'])
+            errors.append((element_id, error))
+        return errors
+
+    def query(self, session, content_type, attributes, offset, limit,
+              details):
+        """
+          Sends one page of a queryContext, returning a tuple of
+          (contextResponses, total count or None without details).
+        """
+        headers = {
+            'content-type': 'application/json',
+            'accept': 'application/json',
+        }
+        json_data = {
+            'entities': [
+                {
+                    'type': content_type,
+                    'isPattern': 'true',
+                    'id': '.*',
+                },
+            ],
+        }
+        # If the method received a list of attributes
+        if attributes and type(attributes) == type(list()):
+            json_data['attributes'] = attributes
+        params = {'offset': offset, 'limit': limit}
+        if details:
+            params['details'] = 'on'
+        response = session.post(
+            self.get_url(),
+            params=params,
+            data=dumps(json_data),
+            headers=headers,
+        )
+        fiware_error = 'FiWare returned:\n\n'
+        if response.status_code != 200:
+            raise FiWareError(fiware_error + response.content)
+        content = loads(response.content)
+        error = content.get('errorCode', {})
+        if error.get('code') == '404':
+            # No context element found
+            return [], 0
+        elif error and error.get('code') != '200':
+            raise FiWareError(fiware_error + response.content)
+        # With details=on Orion says "Count: <total>" in the details
+        count = re.search(r'Count: (\d+)', error.get('details', ''))
+        count = int(count.group(1)) if count else None
+        return content.get('contextResponses', []), count
+
+    @staticmethod
+    def get_id(entity):
+        """ Returns the id of a queried entity """
+        return entity['contextElement']['id']
+
+
+class NGSIv2Backend(NGSI10Backend):
+    """
+      ContextBroker's NGSIv2 API: keyValues entities sent in batches
+      with /v2/op/update and queried (paginated) from /v2/entities.
+      Payloads are less than half of NGSI10's for the same data.
+    """
+    version = 'v2'
+    serializer = KeyValuesSerializer
+    results_key = 'entities'
+    update_params = {'options': 'keyValues'}
+
+    @staticmethod
+    def wrap_batch(elements):
+        """
+          Wraps a list of already serialized entities
+          into a single append payload.
+        """
+        return ''.join([
+            '{"actionType":"append","entities":[',
+            ','.join(elements),
+            ']}',
+        ])
+
+    @staticmethod
+    def get_batch_errors(response, element_ids):
+        """
+          /v2/op/update answers 204 when the whole batch was
+          applied, otherwise the error is reported for every
+          element in the batch.
+        """
+        if response.status_code in (200, 204):
+            return []
+        return [(each, response.content) for each in element_ids]
+
+    def query(self, session, content_type, attributes, offset, limit,
+              details):
+        """
+          Gets one page of keyValues entities, returning a tuple of
+          (entities, total count or None without details).
+        """
+        params = {
+            'type': content_type,
+            'offset': offset,
+            'limit': limit,
+            'options': 'keyValues,count' if details else 'keyValues',
+        }
+        if attributes and type(attributes) == type(list()):
+            params['attrs'] = ','.join(attributes)
+        response = session.get(
+            self.get_url(),
+            params=params,
+            headers={'accept': 'application/json'},
+        )
+        if response.status_code != 200:
+            raise FiWareError('FiWare returned:\n\n' + response.content)
+        count = response.headers.get('Fiware-Total-Count')
+        count = int(count) if count is not None else None
+        return loads(response.content), count
+
+    @staticmethod
+    def get_id(entity):
+        """ Returns the id of a queried entity """
+        return entity['id']
+
+
+BACKENDS = {
+    NGSI10Backend.version: NGSI10Backend,
+    NGSIv2Backend.version: NGSIv2Backend,
+}
+
+
+def get_backend(host, version=FIWARE_API_VERSION):
+    """ Returns the ContextBroker API backend of a version (v1 or v2) """
+    if version not in BACKENDS:
+        raise FiWareError('Unknown FiWare API version: {}'.format(version))
+    return BACKENDS[version](host)
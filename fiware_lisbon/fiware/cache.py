@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import hashlib
+import os
+import tempfile
+import time
+from collections import namedtuple
+from threading import Lock
+from urllib import urlencode
+from urlparse import parse_qsl
+from urlparse import urlsplit
+from urlparse import urlunsplit
+
+from utils.constants import CRAWLER_CACHE_DIR
+from utils.constants import CRAWLER_CACHE_SIZE
+from utils.constants import CRAWLER_CACHE_TTL
+from utils.constants import CRAWLER_OFFLINE
+from utils.codec import dumps
+from utils.codec import loads
+
+
+# Response-like object served from the cache, enough for parse_response
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['url', 'status_code', 'content', 'headers'],
+)
+
+
+class ResponseCache(object):
+    """ On-disk cache of OST API responses, keyed by URL without API key """
+
+    def __init__(self, directory=CRAWLER_CACHE_DIR, ttl=CRAWLER_CACHE_TTL,
+                 max_size=CRAWLER_CACHE_SIZE, offline=CRAWLER_OFFLINE):
+        """
+          - directory = where the responses are stored
+          - ttl = seconds a response is served without revalidation
+          - max_size = bytes on disk before the oldest entries are evicted
+          - offline = serve everything from the cache, never hit OST
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        # Bytes on disk, computed when the first entry is written
+        self.size = None
+        self.lock = Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def get_key(url):
+        """
+          Returns the cache key of an URL, which is the
+          hash of the URL without the ?key= parameter.
+        """
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        params = [(key, value) for key, value in parse_qsl(query)
+                  if key != 'key']
+        url = urlunsplit((scheme, netloc, path, urlencode(params), ''))
+        return hashlib.sha1(url).hexdigest()
+
+    def get_path(self, url):
+        """ Returns the file where the URL's response is stored """
+        return os.path.join(self.directory, self.get_key(url) + '.json')
+
+    def get(self, url):
+        """
+          Returns the cached entry of an URL or None if it's
+          not in the cache. Reading an entry marks it as recently
+          used, so it is the last one to be evicted.
+        """
+        path = self.get_path(url)
+        try:
+            with open(path, 'r') as cache_file:
+                entry = loads(cache_file.read())
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        """ Checks if an entry is younger than the cache's TTL """
+        return time.time() - entry['stored_at'] < self.ttl
+
+    @staticmethod
+    def get_validators(entry):
+        """
+          Returns the headers that make OST answer with
+          304 Not Modified if the cached entry is still valid.
+        """
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def to_response(url, entry):
+        """ Converts a cache entry into a response-like object """
+        return CachedResponse(
+            url=url,
+            status_code=entry['status_code'],
+            content=entry['content'].encode('utf-8'),
+            headers={},
+        )
+
+    def set(self, url, response):
+        """
+          Stores a response, along with its ETag and Last-Modified
+          headers, evicting old entries if the cache is too big.
+        """
+        entry = {
+            'status_code': response.status_code,
+            'content': response.content.decode('utf-8'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'stored_at': time.time(),
+        }
+        self.write(url, entry)
+        return entry
+
+    def refresh(self, url, entry, response):
+        """
+          Marks an entry as fresh again after a 304 Not Modified,
+          updating its validators if OST sent new ones.
+        """
+        entry['etag'] = response.headers.get('ETag', entry.get('etag'))
+        entry['last_modified'] = response.headers.get(
+            'Last-Modified',
+            entry.get('last_modified'),
+        )
+        entry['stored_at'] = time.time()
+        self.write(url, entry)
+        return entry
+
+    def write(self, url, entry):
+        """
+          Writes an entry atomically (temporary file + rename),
+          evicting old entries if the cache gets too big.
+        """
+        path = self.get_path(url)
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(temp_fd, 'w') as cache_file:
+            cache_file.write(dumps(entry))
+        new_size = os.path.getsize(temp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.rename(temp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.get_entries())
+            else:
+                self.size += new_size - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def get_entries(self):
+        """ Returns (last use, size, path) of every file in the cache """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+          Removes the least recently used entries until the
+          cache fits in max_size bytes.
+        """
+        entries = self.get_entries()
+        self.size = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+import sqlite3
+import time
+from threading import RLock
+
+import simplejson
+
+from utils.constants import AGENCY
+from utils.constants import FIWARE_CHECKPOINTS
+from utils.constants import FIWARE_CHECKPOINTS_MAX_AGE
+from utils.constants import ROUTE
+from utils.constants import STOP
+from utils.constants import STOPTIME
+from utils.constants import TRIP
+
+
+# Cursor of a route whose pages were all imported
+FINISHED = 'finished'
+# Between the agency and the start time in a run's id
+RUN_SEPARATOR = '#'
+
+
+def get_run_agency(run):
+    """ Returns the agency of a run's id """
+    return run.rsplit(RUN_SEPARATOR, 1)[0]
+
+
+class Checkpoints(object):
+    """
+      Progress of the imports into the Context Broker: the stages
+      already imported (and their results) and, for each route, the
+      next page to import. A run that failed resumes from there
+      instead of crawling and uploading everything again.
+    """
+
+    def __init__(self, path=FIWARE_CHECKPOINTS,
+                 max_age=FIWARE_CHECKPOINTS_MAX_AGE,
+                 stages=(AGENCY, ROUTE, STOP, TRIP, STOPTIME)):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(
+            path,
+            timeout=60,
+            check_same_thread=False,
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'run TEXT PRIMARY KEY, started_at REAL)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stages ('
+            'run TEXT, stage TEXT, result TEXT, '
+            'PRIMARY KEY (run, stage))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cursors ('
+            'run TEXT, stage TEXT, key TEXT, cursor TEXT, '
+            'PRIMARY KEY (run, stage, key))'
+        )
+        self.connection.commit()
+        # Seconds after which an unfinished run is started over
+        self.max_age = max_age
+        # Stages of a complete run
+        self.stages = stages
+        # Routes are imported by many threads sharing the connection
+        self.lock = RLock()
+
+    def begin(self, agency):
+        """
+          Starts a run of an agency's import, or resumes the last one
+          if it didn't finish and isn't older than max_age. Returns
+          the run's id, unique to it (so that stages other hosts
+          imported in older runs never match), and the time the
+          resumed run started at, or None when starting over.
+        """
+        with self.lock:
+            last_run = self.connection.execute(
+                'SELECT run, started_at FROM runs '
+                'WHERE substr(run, 1, ?) = ? '
+                'ORDER BY started_at DESC LIMIT 1',
+                (len(agency) + 1, agency + RUN_SEPARATOR),
+            ).fetchone()
+            if last_run and not self.is_complete(last_run[0]) and \
+                    time.time() - last_run[1] < self.max_age:
+                return last_run
+            started_at = time.time()
+            run = '{}{}{:.6f}'.format(agency, RUN_SEPARATOR, started_at)
+            self.forget_runs(agency)
+            self.connection.execute(
+                'INSERT INTO runs VALUES (?, ?)',
+                (run, started_at),
+            )
+            self.connection.commit()
+            return run, None
+
+    def clear(self, run):
+        """ Forgets a run's progress """
+        with self.lock:
+            for table in ('runs', 'stages', 'cursors'):
+                self.connection.execute(
+                    'DELETE FROM {} WHERE run = ?'.format(table),
+                    (run,),
+                )
+            self.connection.commit()
+
+    def forget_runs(self, agency, keep=None):
+        """
+          Forgets the progress of an agency's runs, except `keep`
+          (e.g. the older runs' stages imported on this host)
+        """
+        with self.lock:
+            for table in ('runs', 'stages', 'cursors'):
+                self.connection.execute(
+                    'DELETE FROM {} WHERE substr(run, 1, ?) = ? '
+                    'AND run != ?'.format(table),
+                    (len(agency) + 1, agency + RUN_SEPARATOR, keep or ''),
+                )
+            self.connection.commit()
+
+    def is_done(self, run, stage):
+        """ Checks if a stage of the run was imported """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM stages WHERE run = ? AND stage = ?',
+                (run, stage),
+            ).fetchone() is not None
+
+    def get_result(self, run, stage):
+        """ Returns what an imported stage returned (e.g. route ids) """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT result FROM stages WHERE run = ? AND stage = ?',
+                (run, stage),
+            ).fetchone()
+        return simplejson.loads(row[0]) if row else None
+
+    def is_complete(self, run):
+        """ Checks if every stage of the run was imported """
+        with self.lock:
+            done = self.connection.execute(
+                'SELECT COUNT(*) FROM stages WHERE run = ?',
+                (run,),
+            ).fetchone()[0]
+        return done >= len(self.stages)
+
+    def finish_stage(self, run, stage, result=None):
+        """
+          Marks a stage of the run as imported. Once every stage
+          is, the next run starts from the beginning.
+        """
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO stages VALUES (?, ?, ?)',
+                (run, stage, simplejson.dumps(result)),
+            )
+            self.connection.execute(
+                'DELETE FROM cursors WHERE run = ? AND stage = ?',
+                (run, stage),
+            )
+            self.connection.commit()
+
+    def has_cursors(self, run, stage):
+        """ Checks if part of a stage was imported """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT 1 FROM cursors WHERE run = ? AND stage = ? LIMIT 1',
+                (run, stage),
+            ).fetchone() is not None
+
+    def get_cursor(self, run, stage, key):
+        """
+          Returns the URL of the next page to import of a route,
+          FINISHED if it was completely imported or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT cursor FROM cursors '
+                'WHERE run = ? AND stage = ? AND key = ?',
+                (run, stage, unicode(key)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, run, stage, key, cursor):
+        """
+          Records that a route was imported up to the page before
+          cursor (FINISHED or None when it has no more pages).
+        """
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)',
+                (run, stage, unicode(key), cursor or FINISHED),
+            )
+            self.connection.commit()
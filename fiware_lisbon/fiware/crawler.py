@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # encoding: utf-8
 import logging
+import time
+from collections import Counter
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
-import requests
-import simplejson
+from requests.exceptions import ConnectionError
+from requests.exceptions import Timeout
 
 from utils.constants import AGENCY_QUERY
 from utils.constants import API_AGENCIES
@@ -11,6 +16,12 @@ from utils.constants import API_ROUTES
 from utils.constants import API_STOPS
 from utils.constants import API_TRIPS
 from utils.constants import API_STOPTIMES
+from utils.constants import CRAWLER_CACHE_DIR
+from utils.constants import CRAWLER_PAGE_SIZE
+from utils.constants import CRAWLER_PREFETCH
+from utils.constants import CRAWLER_RATE
+from utils.constants import CRAWLER_RETRIES
+from utils.constants import CRAWLER_WORKERS
 from utils.constants import OST_API_MAIN_URL
 from utils.constants import ROUTE
 from utils.constants import ROUTE_QUERY
@@ -18,14 +29,96 @@ from utils.constants import TRIP
 from utils.errors import APIKeyError
 from utils.errors import CrawlerError
 from utils.errors import OSTError
+from utils.codec import loads
+from utils.sessions import get_session
+from utils.throttle import RetryPolicy
+from utils.throttle import TokenBucket
+from utils.utils import imap_bounded
+from cache import ResponseCache
 
 
 class Crawler(object):
     """ Crawler to retrieve CP data from OST APIs """
-    
-    def __init__(self):
+
+    def __init__(self, workers=CRAWLER_WORKERS, session=None, cache=None,
+                 rate=CRAWLER_RATE, retries=CRAWLER_RETRIES,
+                 prefetch=CRAWLER_PREFETCH, page_size=CRAWLER_PAGE_SIZE):
         requests_log = logging.getLogger("requests")
         requests_log.setLevel(logging.WARNING)
+        # Maximum number of routes being crawled at the same time
+        self.workers = workers
+        # Keep-alive connections to OST, two per worker (for prefetching)
+        self.session = session or get_session(OST_API_MAIN_URL, 2 * workers)
+        # On-disk cache of OST responses, if there's a folder for it
+        if cache is None and CRAWLER_CACHE_DIR:
+            cache = ResponseCache()
+        self.cache = cache
+        # At most `rate` requests per second, retrying transient errors
+        self.bucket = TokenBucket(rate, capacity=workers)
+        self.retry_policy = RetryPolicy(retries)
+        self.stats = Counter()
+        self.stats_lock = Lock()
+        # Fetch the next page while the current one is processed and
+        # ask OST for bigger pages (None keeps the API's default)
+        self.prefetch = prefetch
+        self.page_size = page_size
+
+    def count(self, **stats):
+        """ Adds values to the Crawler's counters (thread-safe) """
+        with self.stats_lock:
+            self.stats.update(stats)
+
+    @staticmethod
+    def get_error_class(request):
+        """
+          Returns the kind of transient error of an OST response,
+          or None if it's not worth retrying.
+        """
+        if request.status_code == 200 and \
+                'Temporarily Down' in request.content:
+            return 'maintenance'
+        elif request.status_code == 429:
+            return 'throttled'
+        elif request.status_code == 403:
+            return 'forbidden'
+        elif request.status_code in [500, 502, 503, 504]:
+            return 'server'
+        return None
+
+    def get(self, api_url, headers=None):
+        """
+          GETs an OST API URL within the rate limit. Transient errors
+          are retried with exponential backoff and jitter (or after
+          the Retry-After header) until their class runs out of retries,
+          when the last response is returned for parse_response.
+        """
+        attempts = Counter()
+        while True:
+            self.count(requests=1, throttled=self.bucket.acquire())
+            try:
+                request = self.session.get(api_url, headers=headers)
+                error_class = self.get_error_class(request)
+                retry_after = request.headers.get('Retry-After')
+            except (ConnectionError, Timeout):
+                request, error_class, retry_after = None, 'connection', None
+            if error_class is None:
+                self.bucket.speed_up()
+                return request
+            if error_class == 'throttled':
+                self.bucket.slow_down()
+            attempts[error_class] += 1
+            if not self.retry_policy.should_retry(
+                    error_class, attempts[error_class]):
+                if request is None:
+                    raise OSTError('OST is down')
+                return request
+            delay = self.retry_policy.get_delay(
+                attempts[error_class],
+                retry_after,
+            )
+            self.count(retries=1, backoff=delay)
+            self.count(**{'retries_' + error_class: 1})
+            time.sleep(delay)
 
     @staticmethod
     def validate_key(url):
@@ -46,7 +139,9 @@ class Crawler(object):
         down_for_maintenance = request.status_code == 200 and \
             'Temporarily Down' in request.content
         if request.status_code == 200 and not down_for_maintenance:
-            content = simplejson.loads(request.content)
+            started_at = time.time()
+            content = loads(request.content)
+            self.count(parsing=time.time() - started_at)
             return content.get('Objects'), content.get('Meta'),
         elif request.status_code == 401:
             # HTTP 401 - Unauthorized
@@ -55,70 +150,163 @@ class Crawler(object):
             # HTTP 404 - bad URL (not found or without key)
             if self.validate_key(request.url):
                 raise CrawlerError('API not found:\n' + request.url)
-        elif request.status_code in [403, 500, 502] or down_for_maintenance:
-            # Internal Server Error, Bad Gateway, Down for Maintenance
+        elif request.status_code in [403, 429, 500, 502, 503, 504] or \
+                down_for_maintenance:
+            # Forbidden, Too Many Requests, Server Errors, Maintenance
             raise OSTError('OST is down')
         return None
 
+    def fetch(self, api_url):
+        """
+          GETs an OST API URL. If the Crawler has a cache, fresh
+          pages are served from disk and stale ones are revalidated
+          with their ETag/Last-Modified (costing a 304 if unchanged).
+        """
+        if self.cache is None:
+            return self.get(api_url)
+        entry = self.cache.get(api_url)
+        if entry and (self.cache.offline or self.cache.is_fresh(entry)):
+            return self.cache.to_response(api_url, entry)
+        if self.cache.offline:
+            raise CrawlerError('Page not cached (offline mode):\n' + api_url)
+        headers = self.cache.get_validators(entry)
+        request = self.get(api_url, headers=headers)
+        if request.status_code == 304 and entry:
+            entry = self.cache.refresh(api_url, entry, request)
+            return self.cache.to_response(api_url, entry)
+        if request.status_code == 200 and \
+                'Temporarily Down' not in request.content:
+            self.cache.set(api_url, request)
+        return request
+
     def get_agency(self, agency_name):
         """
           Gets an agency's information by its name.
         """
-        request = requests.get(API_AGENCIES + '&name=%s' % agency_name)
+        request = self.fetch(API_AGENCIES + '&name=%s' % agency_name)
         response, meta = self.parse_response(request)
         return response[0] if response else None
 
-    def get_data_by_agency(self, agency_id, content_type, extra_params=None):
+    def get_page(self, api_url):
         """
-          Gets all routes belonging to an agency.
+          Fetches and parses an API page, returning a tuple of
+          (elements, next page URL or None when it's the last).
+        """
+        request = self.fetch(api_url)
+        response, meta = self.parse_response(request)
+        # Append ?next_page attribute to URL
+        if meta.get('next_page'):
+            next_url = OST_API_MAIN_URL + meta['next_page']
+        else:
+            # End of pages
+            next_url = None
+        return response or [], next_url
+
+    def iter_pages(self, api_url):
+        """
+          Iterates over the pages of an API URL, following the
+          ?next_page attribute until the last page. Yields tuples
+          of (elements, next page URL or None when it's the last).
+          When prefetching, the next page is requested in the
+          background while the caller processes the current one.
+        """
+        if self.page_size and 'limit=' not in api_url:
+            api_url = api_url + '&limit={}'.format(self.page_size)
+        if not self.prefetch:
+            while api_url:
+                response, api_url = self.get_page(api_url)
+                yield response, api_url
+            return
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self.get_page, (api_url,))
+            while pending is not None:
+                response, api_url = pending.get()
+                pending = None
+                if api_url:
+                    pending = pool.apply_async(self.get_page, (api_url,))
+                yield response, api_url
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_data_from_url(self, api_url):
+        """
+          Iterates over every element of an API URL, page by page.
+        """
+        pages = self.iter_pages(api_url)
+        return chain.from_iterable(response for response, _ in pages)
+
+    def get_pages(self, api_url):
+        """
+          Gets every element of an API URL, in every page.
+        """
+        return list(self.iter_data_from_url(api_url))
+
+    def iter_data_by_agency(self, agency_id, content_type, extra_params=None):
+        """
+          Iterates over the routes (or stops) belonging to an
+          agency, yielding them page by page as they arrive.
         """
         if not agency_id:
             raise CrawlerError('No Agency ID was provided')
         if not content_type:
             raise CrawlerError('No Content type was provided')
-        elements = []
-        are_elements_available = True
         api_url = (API_ROUTES if content_type == ROUTE else API_STOPS) \
             + (AGENCY_QUERY.format(agency_id=agency_id))
         if extra_params:
             for key, value in extra_params.iteritems():
                 api_url = api_url + '&{}={}'.format(key, value)
-        while are_elements_available:
-            # Iterate over the API's pages
-            request = requests.get(api_url)
-            response, meta = self.parse_response(request)
-            elements.extend(response)
-            # Append ?next_page attribute to URL
-            if meta.get('next_page'):
-                api_url = OST_API_MAIN_URL + meta['next_page']
-            else:
-                # End of pages, break cycle
-                are_elements_available = False
-        return elements
-
-    def get_data_from_routes(self, routes_list, content_type):
+        return self.iter_data_from_url(api_url)
+
+    def get_data_by_agency(self, agency_id, content_type, extra_params=None):
         """
-          Gets all trips belonging to the given routes ids.
+          Gets all routes belonging to an agency.
+        """
+        return list(self.iter_data_by_agency(
+            agency_id,
+            content_type,
+            extra_params,
+        ))
+
+    @staticmethod
+    def get_route_url(route_id, content_type):
+        """
+          Returns the API URL of the trips (or stoptimes)
+          belonging to a route.
+        """
+        return (API_TRIPS if content_type == TRIP else API_STOPTIMES) \
+            + (ROUTE_QUERY.format(route_id=route_id))
+
+    def iter_data_from_routes(self, routes_list, content_type, workers=None):
+        """
+          Iterates over the trips (or stoptimes) belonging to the given
+          routes ids, in the same order as the routes list.
+          Up to `workers` routes are crawled concurrently (defaults to
+          the Crawler's own limit), each one being held in memory until
+          it's consumed. With a single worker the pages are streamed.
         """
         if not routes_list:
             raise CrawlerError('No Routes IDs were provided')
         if not content_type:
             raise CrawlerError('No Content type was provided')
-        elements = []
-        for route in routes_list:
-            are_elements_available = True
-            api_url = (API_TRIPS if content_type == TRIP else API_STOPTIMES) \
-                + (ROUTE_QUERY.format(route_id=route))
-            while are_elements_available:
-                # Iterate over the API's pages
-                request = requests.get(api_url)
-                response, meta = self.parse_response(request)
-                if len(response) > 0:
-                    elements.extend(response)
-                # Append ?next_page attribute to URL
-                if meta.get('next_page'):
-                    api_url = OST_API_MAIN_URL + meta['next_page']
-                else:
-                    # End of pages, break cycle
-                    are_elements_available = False
-        return elements
+        api_urls = [
+            self.get_route_url(route, content_type)
+            for route in routes_list
+        ]
+        workers = min(workers or self.workers, len(api_urls))
+        if workers > 1:
+            routes = imap_bounded(self.get_pages, api_urls, workers)
+        else:
+            routes = (self.iter_data_from_url(url) for url in api_urls)
+        return chain.from_iterable(routes)
+
+    def get_data_from_routes(self, routes_list, content_type, workers=None):
+        """
+          Gets all trips belonging to the given routes ids.
+        """
+        return list(self.iter_data_from_routes(
+            routes_list,
+            content_type,
+            workers,
+        ))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import hashlib
+import os
+import sqlite3
+from threading import RLock
+
+import simplejson
+
+from utils.constants import FIWARE_SYNC_STATE
+from utils.utils import get_entity_id
+
+
+# Staged elements written per transaction, so that stages running
+# at the same time don't hold the database's lock for long
+STAGED_PER_COMMIT = 1000
+
+
+class SyncState(object):
+    """
+      Fingerprints of the entities last synced to the Context Broker,
+      used to only send the new or changed ones on each run
+    """
+
+    def __init__(self, path=FIWARE_SYNC_STATE):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(
+            path,
+            timeout=60,
+            check_same_thread=False,
+        )
+        # Readers don't wait for the stage that's writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # synced = what's in the Context Broker after the last commit
+        # staged = what was crawled since the last commit
+        for table in ('synced', 'staged'):
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} ('
+                'type TEXT, id TEXT, fingerprint TEXT, '
+                'PRIMARY KEY (type, id))'.format(table)
+            )
+        self.connection.commit()
+        self.changed = {}
+        # Parts of a type may be staged by many threads
+        self.lock = RLock()
+
+    @staticmethod
+    def get_fingerprint(content):
+        """ Returns a hash of the element's content """
+        serialized = simplejson.dumps(content, sort_keys=True)
+        return hashlib.sha1(serialized).hexdigest()
+
+    def reset(self, content_type):
+        """ Forgets the elements staged since the last commit """
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM staged WHERE type = ?',
+                (content_type,),
+            )
+            self.connection.commit()
+            self.changed[content_type] = 0
+
+    def diff(self, content, content_type, reset=True):
+        """
+          Iterates over the crawled content, yielding only the
+          elements that are new or changed since the last sync.
+          Every element is staged until commit() is called.
+          When the content is staged in parts (e.g. by many
+          subtasks) reset the staging once and pass reset=False,
+          changed elements being counted across the parts.
+        """
+        if reset:
+            self.reset(content_type)
+        self.changed.setdefault(content_type, 0)
+        if type(content) == type(dict()):
+            # Just one element, convert to a list
+            content = [content]
+        for index, each in enumerate(content, 1):
+            element_id = unicode(get_entity_id(each))
+            fingerprint = self.get_fingerprint(each)
+            with self.lock:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO staged VALUES (?, ?, ?)',
+                    (content_type, element_id, fingerprint),
+                )
+                synced = self.connection.execute(
+                    'SELECT fingerprint FROM synced WHERE type = ? AND id = ?',
+                    (content_type, element_id),
+                ).fetchone()
+                if index % STAGED_PER_COMMIT == 0:
+                    self.connection.commit()
+                changed = synced is None or synced[0] != fingerprint
+                if changed:
+                    self.changed[content_type] += 1
+            if changed:
+                yield each
+        with self.lock:
+            self.connection.commit()
+
+    def commit(self, content_type):
+        """
+          Marks the staged elements as synced, once they were all
+          inserted into the Context Broker. Returns the ids of the
+          elements that were synced before but weren't crawled now.
+        """
+        with self.lock:
+            removed = [row[0] for row in self.connection.execute(
+                'SELECT id FROM synced WHERE type = ? AND id NOT IN '
+                '(SELECT id FROM staged WHERE type = ?)',
+                (content_type, content_type),
+            )]
+            self.connection.execute(
+                'DELETE FROM synced WHERE type = ?',
+                (content_type,),
+            )
+            self.connection.execute(
+                'INSERT INTO synced SELECT * FROM staged WHERE type = ?',
+                (content_type,),
+            )
+            self.connection.execute(
+                'DELETE FROM staged WHERE type = ?',
+                (content_type,),
+            )
+            self.connection.commit()
+            return removed
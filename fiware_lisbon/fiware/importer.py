@@ -1,34 +1,60 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import requests
-import simplejson
+import time
+from collections import Counter
+from threading import Lock
 
+from requests.exceptions import RequestException
+
+from utils.constants import FIWARE_BATCH_BYTES
+from utils.constants import FIWARE_BATCH_SIZE
 from utils.constants import FIWARE_HOST
+from utils.constants import FIWARE_PAGE_SIZE
+from utils.constants import FIWARE_WORKERS
 from utils.constants import FIWARE_GOOD_STATUS
+from utils.constants import ID
 from utils.errors import FiWareError
-from utils.utils import get_fiware_api
+from utils.codec import dumps
+from utils.codec import loads
+from utils.sessions import get_session
+from utils.utils import batches
+from utils.utils import get_entity_id
+from utils.utils import imap_bounded
+from backends import get_backend
+
+
+# Failed elements listed in a FiWareError message
+MAX_REPORTED_ERRORS = 20
 
 
 class FiWare(object):
     """ Helper to insert CP data into Context Broker """
 
+    def __init__(self, host=FIWARE_HOST, session=None,
+                 workers=FIWARE_WORKERS, backend=None):
+        self.host = host
+        # ContextBroker API spoken (NGSI10 or NGSIv2, FIWARE_API_VERSION)
+        self.backend = backend or get_backend(host)
+        # Maximum number of updateContext requests in flight
+        self.workers = workers
+        # Keep-alive connections to the Context Broker, one per worker
+        self.session = session or get_session(host, workers)
+        # Elements inserted (and failed), and entities/s of the last insert
+        self.stats = Counter()
+        self.stats_lock = Lock()
+        self.throughput = 0.0
+        # Serializers compiled for each content type
+        self.serializers = {}
+
     @staticmethod
-    def wrap_content(content, content_type):
+    def wrap_element(content, content_type):
         """
-          ContextBroker requires a specific JSON schema
-          when inserting data. This method wraps the
-          data to be inserted with that schema.
+          Converts an OST element into a ContextBroker
+          contextElement (type, id and list of attributes).
         """
-        # This is the schema to be received by the ContextBroker
-        fiware_content = {'contextElements': [], 'updateAction': 'APPEND'}
         try:
-            # Element has id, act normally
-            element_id = content.get('id', '')
-            if not element_id:
-                # There is no id but we can replace it with resource_uri
-                element_id = {int(string) for string in
-                              content['resource_uri'].split('/')
-                              if string.isdigit()}.pop()
+            # Element's id (or the one in its resource_uri)
+            element_id = get_entity_id(content)
             element = {
                 'type': content_type,
                 'isPattern': 'false',
@@ -43,9 +69,7 @@ class FiWare(object):
                 keys = value.keys()
                 if 'id' not in keys and 'resource_uri' in keys:
                     # No id but we can replace it with resource_uri
-                    value = {int(string) for string in
-                             value['resource_uri'].split('/')
-                             if string.isdigit()}.pop()
+                    value = get_entity_id(value)
                     key = 'id'
                 else:
                     value = value.get('id')
@@ -72,9 +96,59 @@ class FiWare(object):
                 'value': value,
             }
             element['attributes'].append(attribute)
-        fiware_content['contextElements'].append(element)
-        # print simplejson.dumps(fiware_content, indent=' ' * 4) # DEBUG
-        return simplejson.dumps(fiware_content)
+        return element
+
+    @staticmethod
+    def wrap_content(content, content_type):
+        """
+          ContextBroker requires a specific JSON schema
+          when inserting data. This method wraps the
+          data to be inserted with that schema.
+        """
+        # This is the schema to be received by the ContextBroker
+        fiware_content = {
+            'contextElements': [FiWare.wrap_element(content, content_type)],
+            'updateAction': 'APPEND',
+        }
+        return dumps(fiware_content)
+
+    def get_serializer(self, content_type):
+        """
+          Returns the serializer of a content type, which compiles
+          the elements' layout the first time it's used.
+        """
+        if content_type not in self.serializers:
+            self.serializers[content_type] = self.backend.serializer(
+                content_type,
+                fallback=self.wrap_element,
+            )
+        return self.serializers[content_type]
+
+    def wrap_many(self, content, content_type):
+        """
+          Wraps a list of elements into a single APPEND payload,
+          like wrap_content does for one element (in the
+          backend's format).
+        """
+        return self.get_serializer(content_type).wrap_many(content)
+
+    def serialize_elements(self, content, content_type):
+        """
+          Iterates over the content, yielding tuples of
+          (element id, contextElement serialized as JSON).
+        """
+        serializer = self.get_serializer(content_type)
+        elapsed = 0.0
+        try:
+            for each in content:
+                started_at = time.time()
+                serialized = serializer.serialize(each)
+                elapsed += time.time() - started_at
+                yield serialized
+        finally:
+            # Time spent serializing (not crawling nor uploading)
+            with self.stats_lock:
+                self.stats['serializing'] += elapsed
 
     @staticmethod
     def handle_response(response):
@@ -86,12 +160,75 @@ class FiWare(object):
         fiware_error = 'FiWare returned:\n\n'
         if response.status_code != 200:
             return False, fiware_error + response.content
-        content = simplejson.loads(response.content)
+        content = loads(response.content)
         if 'errorCode' in content.keys():
             return False, fiware_error + response.content
         if content['contextResponses'][0]['statusCode'] == FIWARE_GOOD_STATUS:
             return True, content
 
+    def query(self, content_type, attributes=None, offset=0,
+              limit=FIWARE_PAGE_SIZE, details=False):
+        """
+          Sends a single (paginated) query to the FiWare
+          ContextBroker instance, returning a tuple of
+          (entities, total count or None without details).
+          - content_type = Entity type name
+          - attributes = List of attributes to query
+          - offset, limit = Entities to skip and to return
+          - details = Ask Orion to count all the matching entities
+        """
+        return self.backend.query(
+            self.session,
+            content_type,
+            attributes,
+            offset,
+            limit,
+            details,
+        )
+
+    def iter_data(self, content_type, attributes=None,
+                  page_size=FIWARE_PAGE_SIZE):
+        """
+          Iterates over all the entities of a type in the
+          ContextBroker, page by page (Orion truncates
+          unpaginated queries), yielding contextResponses
+          (or keyValues entities with NGSIv2).
+        """
+        offset = 0
+        while True:
+            entities, count = self.query(
+                content_type,
+                attributes,
+                offset=offset,
+                limit=page_size,
+            )
+            for each in entities:
+                yield each
+            if len(entities) < page_size:
+                break
+            offset += page_size
+
+    def iter_ids(self, content_type, page_size=FIWARE_PAGE_SIZE):
+        """
+          Iterates over the ids of all the entities of a type,
+          only asking for their id attribute.
+        """
+        for each in self.iter_data(content_type, [ID], page_size):
+            yield self.backend.get_id(each)
+
+    def count(self, content_type):
+        """
+          Returns the number of entities of a type in the
+          ContextBroker, without downloading them.
+        """
+        entities, count = self.query(
+            content_type,
+            [ID],
+            limit=1,
+            details=True,
+        )
+        return count if count is not None else len(entities)
+
     def get_data(self, content_type, attributes=None):
         """
           Method to query data from the FiWare
@@ -99,31 +236,11 @@ class FiWare(object):
           - content_type = Entity type name
           - attributes = List of attributes to query
         """
-        # Get the API URL and set Headers
-        api_url = get_fiware_api(fiware_host=FIWARE_HOST)
-        headers = {
-            'content-type': 'application/json',
-            'accept': 'application/json',
-        }
-        json_data = {
-            'entities': [
-                {
-                    'type': content_type,
-                    'isPattern': 'true',
-                    'id': '.*',
-                },
-            ],
+        return {
+            self.backend.results_key: list(
+                self.iter_data(content_type, attributes),
+            ),
         }
-        # If the method received a list of attributes
-        if attributes and type(attributes) == type(list()):
-            json_data['attributes'] = attributes
-        response = requests.post(
-            api_url,
-            data=simplejson.dumps(json_data),
-            headers=headers,
-        )
-        all_ok, response_content = self.handle_response(response)
-        return response_content
 
     @staticmethod
     def get_ids(content):
@@ -131,40 +248,84 @@ class FiWare(object):
           Gets the list of ids of a query response
         """
         id_list = []
-        if content:
+        if content and 'entities' in content:
+            # NGSIv2 keyValues entities
+            id_list = [each['id'] for each in content.get('entities')]
+        elif content:
             id_list = [each.get('contextElement')['id']
                        for each in content.get('contextResponses')]
         return id_list
 
-    def insert_data(self, content, content_type):
+    def post_batch(self, batch):
         """
-          Method to insert data into the FiWare
-          ContextBroker instance.
+          Posts a batch of (element id, serialized element) tuples
+          with one update request, returning the number of elements
+          and the list of errors of the ones that failed.
         """
         # Get the API URL and set Headers
-        api_url = get_fiware_api(fiware_host=FIWARE_HOST, update=True)
-        all_ok = True
+        api_url = self.backend.get_url(update=True)
         headers = {
             'content-type': 'application/json',
             'accept': 'application/json',
         }
+        element_ids = [element_id for element_id, _ in batch]
+        try:
+            # Post the data, wrapped with ContextBroker expected syntax
+            response = self.session.post(
+                api_url,
+                params=self.backend.update_params,
+                data=self.backend.wrap_batch(
+                    [element for _, element in batch],
+                ),
+                headers=headers,
+            )
+        except RequestException as error:
+            return len(batch), [(each, str(error)) for each in element_ids]
+        errors = self.backend.get_batch_errors(response, element_ids)
+        return len(batch), errors
+
+    def insert_data(self, content, content_type, batch_size=FIWARE_BATCH_SIZE,
+                    max_bytes=FIWARE_BATCH_BYTES, workers=None):
+        """
+          Method to insert data into the FiWare
+          ContextBroker instance. Content can be one element,
+          a list or any iterable (such as the Crawler's iter_*).
+          Elements are sent in batches of up to batch_size elements
+          and max_bytes of payload per updateContext request, with
+          up to `workers` requests in flight. A failed batch doesn't
+          stop the others: all errors are raised, in order, at the end.
+        """
         if type(content) == type(dict()):
             # Just one element, convert to a list
             content = [content]
-        # Wrap the content with ContextBroker expected syntax
-        for each in content:
-            # Change the content to match ContextBroker expected JSON
-            json_content = self.wrap_content(each, content_type)
-            # Post the data
-            response = requests.post(
-                api_url,
-                data=json_content,
-                headers=headers,
+        # Change the content to match ContextBroker expected JSON
+        elements = self.serialize_elements(content, content_type)
+        get_size = lambda item: len(item[1])
+        content_batches = batches(elements, batch_size, max_bytes, get_size)
+        started_at = time.time()
+        entities, errors = 0, []
+        results = imap_bounded(
+            self.post_batch,
+            content_batches,
+            workers or self.workers,
+        )
+        for batch_entities, batch_errors in results:
+            entities += batch_entities
+            errors.extend(batch_errors)
+        elapsed = time.time() - started_at
+        with self.stats_lock:
+            self.throughput = entities / elapsed if elapsed else 0.0
+            self.stats.update(entities=entities, errors=len(errors))
+        if errors:
+            failed = '\n'.join(
+                '{}: {}'.format(element_id, error)
+                for element_id, error in errors[:MAX_REPORTED_ERRORS]
             )
-            all_ok, response_content = self.handle_response(response)
-            if all_ok is not True:
-                response = simplejson.dumps(response_content)
-                template = '{type} update unsuccessful.\n\n{resp}'
-                message = template.format(type=content_type, resp=response)
-                raise FiWareError(message)
-        return all_ok
+            if len(errors) > MAX_REPORTED_ERRORS:
+                failed += '\n... and {} more'.format(
+                    len(errors) - MAX_REPORTED_ERRORS,
+                )
+            template = '{type} update unsuccessful.\n\n{resp}'
+            message = template.format(type=content_type, resp=failed)
+            raise FiWareError(message)
+        return True
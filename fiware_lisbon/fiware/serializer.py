@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import re
+
+from simplejson.encoder import encode_basestring_ascii
+
+from utils.codec import dumps
+from utils.utils import get_entity_id
+
+
+# Kinds of fields of an OST element
+PLAIN = 0  # Attribute with the same name and value
+REFERENCE = 1  # Nested element, only its id is kept
+URI_REFERENCE = 2  # Nested element without id (taken from resource_uri)
+POINT = 3  # GeoJSON point, converted to 'latitude,longitude' coordinates
+
+# resource_uri ids remembered by each serializer
+MAX_MEMOIZED_URIS = 100000
+
+# Conditions for an element not to follow the compiled layout
+GUARDS = {
+    PLAIN: 'type({v}) is dict',
+    REFERENCE: "type({v}) is not dict or "
+               "('id' not in {v} and 'resource_uri' in {v})",
+    URI_REFERENCE: "type({v}) is not dict or "
+                   "'id' in {v} or 'resource_uri' not in {v}",
+    POINT: None,
+}
+
+# JSON of each kind of field's value. Plain values are encoded inline
+# when they have the same type as in the first element
+VALUES = {
+    REFERENCE: 'encode_value({v}.get("id"))',
+    URI_REFERENCE: 'encode_uri_id({v}["resource_uri"])',
+    POINT: 'encode_string(str({v}["coordinates"][1]) + "," + '
+           'str({v}["coordinates"][0]))',
+}
+PLAIN_VALUES = {
+    str: '(encode_string({v}) if type({v}) in strings else dumps({v}))',
+    unicode: '(encode_string({v}) if type({v}) in strings else dumps({v}))',
+    int: '(str({v}) if type({v}) is int else dumps({v}))',
+}
+
+# Attribute of each kind of field, '%s' being its value. The
+# URI_REFERENCE attribute ends up named 'id', as in FiWare.wrap_element
+ATTRIBUTES = {
+    PLAIN: '{{"name":{name},"value":%s}}',
+    REFERENCE: '{{"name":{name},"value":%s}}',
+    URI_REFERENCE: '{{"name":"id","value":%s}}',
+    POINT: '{{"name":"coordinates","type":"coords","value":%s,'
+           '"metadatas":[{{"name":"location","type":"string",'
+           '"value":"WSG84"}}]}}',
+}
+
+# Characters NGSIv2 refuses in attribute values, sent percent-encoded
+FORBIDDEN_CHARACTERS = re.compile(r'[%<>"\'=;()]')
+
+
+class ElementSerializer(object):
+    """
+      Serializes OST elements of one content type into ContextBroker
+      contextElements. The fields' layout is learnt from the first
+      element and compiled into a function that writes the JSON
+      directly, falling back to the generic conversion
+      (FiWare.wrap_element) when an element doesn't match it.
+    """
+
+    def __init__(self, content_type, fallback):
+        self.content_type = content_type
+        self.fallback = fallback
+        self.dumps = dumps
+        self.source = None
+        self.convert = None
+        # JSON of the ids found in resource_uris (e.g. a StopTime's trip)
+        self.uri_ids = {}
+
+    def encode_uri_id(self, resource_uri):
+        """ Returns the JSON of the id in a resource_uri (memoized) """
+        encoded = self.uri_ids.get(resource_uri)
+        if encoded is None:
+            if len(self.uri_ids) >= MAX_MEMOIZED_URIS:
+                self.uri_ids.clear()
+            element_id = get_entity_id({'resource_uri': resource_uri})
+            encoded = self.encode_value(element_id)
+            self.uri_ids[resource_uri] = encoded
+        return encoded
+
+    def encode_value(self, value):
+        """ Returns the JSON of a value, with a shortcut for int ids """
+        if type(value) is int:
+            return str(value)
+        return self.dumps(value)
+
+    def serialize_fallback(self, content):
+        """ Serializes an element which doesn't follow the layout """
+        element = self.fallback(dict(content), self.content_type)
+        return element['id'], self.dumps(element)
+
+    def compile(self, content):
+        """
+          Learns the element's layout (the kind of each field but
+          resource_uri) and generates a function that serializes
+          elements with that layout, without inspecting each field.
+        """
+        lines, attributes, values = [], [], []
+        for index, (key, value) in enumerate(sorted(content.iteritems())):
+            if key == 'resource_uri':
+                continue
+            variable = 'v{}'.format(index)
+            lines.append('    {} = content[{!r}]'.format(variable, key))
+            if key == 'point':
+                kind = POINT
+            elif type(value) == type(dict()):
+                if 'id' not in value and 'resource_uri' in value:
+                    kind = URI_REFERENCE
+                else:
+                    kind = REFERENCE
+            else:
+                kind = PLAIN
+            if GUARDS[kind]:
+                lines.append('    if ' + GUARDS[kind].format(v=variable) + ':')
+                lines.append('        return serialize_fallback(content)')
+            name = encode_basestring_ascii(key).replace('%', '%%')
+            attributes.append(ATTRIBUTES[kind].format(name=name))
+            if kind == PLAIN:
+                value_code = PLAIN_VALUES.get(type(value), 'dumps({v})')
+            else:
+                value_code = VALUES[kind]
+            values.append(value_code.format(v=variable))
+        template = ''.join([
+            '{"type":',
+            encode_basestring_ascii(self.content_type).replace('%', '%%'),
+            ',"isPattern":"false","id":%s,"attributes":[',
+            ','.join(attributes),
+            ']}',
+        ])
+        source = '\n'.join(
+            ['def serialize(content):',
+             '    if content.viewkeys() != keys:',
+             '        return serialize_fallback(content)'] +
+            lines +
+            ['    element_id = get_entity_id(content)',
+             '    return element_id, template % (',
+             '        encode_value(element_id),'] +
+            ['        {},'.format(value) for value in values] +
+            ['    )']
+        )
+        namespace = {
+            'keys': set(content.keys()),
+            'template': template,
+            'strings': (str, unicode),
+            'dumps': self.dumps,
+            'encode_string': encode_basestring_ascii,
+            'encode_value': self.encode_value,
+            'encode_uri_id': self.encode_uri_id,
+            'get_entity_id': get_entity_id,
+            'serialize_fallback': self.serialize_fallback,
+        }
+        code = compile(source, '<{} serializer>'.format(self.content_type),
+                       'exec')
+        exec code in namespace
+        self.source = source
+        self.convert = namespace['serialize']
+
+    def serialize(self, content):
+        """
+          Serializes an OST element as a contextElement, returning
+          a tuple of (element id, contextElement as JSON).
+        """
+        if self.convert is None:
+            self.compile(content)
+        return self.convert(content)
+
+    def wrap_many(self, contents):
+        """
+          Wraps many OST elements into a single APPEND payload,
+          serialized as JSON.
+        """
+        return ''.join([
+            '{"contextElements":[',
+            ','.join([self.serialize(each)[1] for each in contents]),
+            '],"updateAction":"APPEND"}',
+        ])
+
+
+class KeyValuesSerializer(object):
+    """
+      Serializes OST elements of one content type into NGSIv2
+      keyValues entities ({"id": ..., "type": ..., "name": value}),
+      without NGSI10's attribute and metadata envelope. Nested
+      elements are replaced with their id and points with
+      'latitude,longitude' coordinates, as in FiWare.wrap_element.
+    """
+
+    def __init__(self, content_type, fallback=None):
+        self.content_type = content_type
+        self.dumps = dumps
+
+    @staticmethod
+    def encode_string(value):
+        """ Percent-encodes the characters NGSIv2 forbids in values """
+        return FORBIDDEN_CHARACTERS.sub(
+            lambda match: '%{:02X}'.format(ord(match.group())),
+            value,
+        )
+
+    def to_entity(self, content):
+        """ Converts an OST element into a keyValues entity """
+        element_id = get_entity_id(content)
+        # NGSIv2 entity ids are strings
+        entity = {'id': unicode(element_id), 'type': self.content_type}
+        for key, value in content.iteritems():
+            if key in ('id', 'resource_uri'):
+                continue
+            if key == 'point':
+                key = 'coordinates'
+                value = str(value['coordinates'][1]) + ',' \
+                    + str(value['coordinates'][0])
+            elif type(value) == type(dict()):
+                if 'id' not in value and 'resource_uri' in value:
+                    value = get_entity_id(value)
+                else:
+                    value = value.get('id')
+            elif isinstance(value, basestring):
+                value = self.encode_string(value)
+            entity[key] = value
+        return element_id, entity
+
+    def serialize(self, content):
+        """
+          Serializes an OST element as a keyValues entity, returning
+          a tuple of (element id, entity as JSON).
+        """
+        element_id, entity = self.to_entity(content)
+        return element_id, self.dumps(entity)
+
+    def wrap_many(self, contents):
+        """
+          Wraps many OST elements into a single append payload
+          for /v2/op/update, serialized as JSON.
+        """
+        return ''.join([
+            '{"actionType":"append","entities":[',
+            ','.join([self.serialize(each)[1] for each in contents]),
+            ']}',
+        ])
@@ -1,5 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import time
+from collections import Counter
+from functools import partial
+
+from celery import chain
+from celery import chord
+from celery import current_app
+from celery import group
 from celery.task import task
 from colorama import Fore
 
@@ -9,65 +17,380 @@ from utils.constants import ROUTE
 from utils.constants import STOP
 from utils.constants import TRIP
 from utils.constants import STOPTIME
+from utils.constants import FIWARE_DELTA_SYNC
+from utils.constants import ROUTES_CHUNK_SIZE
 from utils.constants import ID
 from utils.errors import APIKeyError
 from utils.errors import CrawlerError
 from utils.errors import OSTError
 from utils.errors import FiWareError
+from utils.utils import get_entity_id
 from utils.utils import get_error_message
+from utils.utils import imap_bounded
+from checkpoints import Checkpoints
+from checkpoints import FINISHED
+from checkpoints import get_run_agency
 from crawler import Crawler
+from delta import SyncState
 from importer import FiWare
 
 
-@task(name='transfer_gtfs_cb', ignore_result=True)
-def transfer_gtfs_cb(agency_name=None):
+# Errors that stop a stage (and the ones depending on it)
+STAGE_ERRORS = (APIKeyError, CrawlerError, OSTError, FiWareError)
+
+
+def push_data(fiware, content, content_type, sync_state=None):
     """
-      Fetches CP data from OST APIs and puts it on ContextBroker
-      Uses the Crawler to fetch data and FiWare to import it.
-      # 1st) Agency == CP
-      # 2nd) CP Routes
-      # 3rd) CP Stops
-      # 4th) CP Trips
-      # 5th) CP StopTimes
+      Inserts the crawled content into the ContextBroker. With a
+      sync state only new or changed elements are sent, and the
+      elements that disappeared from OST are reported.
+    """
+    if sync_state is None:
+        return fiware.insert_data(content, content_type=content_type)
+    changed = sync_state.diff(content, content_type)
+    fiware.insert_data(changed, content_type=content_type)
+    removed = sync_state.commit(content_type)
+    print '({} changed, {} removed)'.format(
+        sync_state.changed[content_type],
+        len(removed),
+    ),
+    if removed:
+        removed_ids = ', '.join(removed[:10])
+        if len(removed) > 10:
+            removed_ids += '...'
+        print '\n  Removed from OST:', removed_ids, '\n ',
+
+
+def report_throughput(fiware):
+    """ Returns the entities/s of the last insertion into ContextBroker """
+    return '({:.1f} entities/s)'.format(fiware.throughput)
+
+
+def collect_ids(content, ids):
+    """ Passes the content through, appending each element's id to ids """
+    for each in content:
+        ids.append(get_entity_id(each))
+        yield each
+
+
+def report_stage(content_type, fiware, crawler):
+    """ Prints the results of a stage, in one line """
+    print '> {}: Done, {} in ContextBroker {}. OST: {} requests, ' \
+        '{} retries, {:.1f}s throttled. JSON: {:.1f}s parsing, ' \
+        '{:.1f}s serializing'.format(
+            content_type,
+            fiware.count(content_type),
+            report_throughput(fiware),
+            crawler.stats['requests'],
+            crawler.stats['retries'],
+            crawler.stats['throttled'] + crawler.stats['backoff'],
+            crawler.stats['parsing'],
+            fiware.stats['serializing'],
+        )
+
+
+def report_error(error):
+    """ Prints the error that stopped a stage """
+    message = get_error_message(error)
+    print(Fore.RED + str(error) + Fore.RESET + ':' + message)
+
+
+def get_checkpoints(run):
     """
+      Returns the checkpoints of a run (None outside of runs),
+      forgetting the agency's older runs kept by this host
+    """
+    if not run:
+        return None
+    checkpoints = Checkpoints()
+    checkpoints.forget_runs(get_run_agency(run), keep=run)
+    return checkpoints
+
+
+def is_imported(checkpoints, run, stage):
+    """ Checks if a resumed run already imported a stage """
+    if checkpoints is not None and checkpoints.is_done(run, stage):
+        print '> {}: Already imported, resuming after it'.format(stage)
+        return True
+    return False
+
+
+@task(name='import_agency_cb', ignore_result=True)
+def import_agency(agency_name=None, delta=FIWARE_DELTA_SYNC, run=None):
+    """
+      1st stage: imports the Agency, returning its id
+      for the next stages.
+    """
+    checkpoints = get_checkpoints(run)
+    if is_imported(checkpoints, run, AGENCY):
+        return checkpoints.get_result(run, AGENCY)
     try:
         crawler = Crawler()
         fiware = FiWare()
+        sync_state = SyncState() if delta else None
         if agency_name is None:
             agency_name = CP_NAME
-        print '> Inserting Agency...   ',
+        print '> Inserting Agency...'
         agency = crawler.get_agency(agency_name)
-        agency_id = agency.get(ID)
-        fiware.insert_data(agency, content_type=AGENCY)
-        print 'Done.'
-        # ROUTES
-        print '> Inserting Routes...   ',
-        routes = crawler.get_data_by_agency(agency_id, content_type=ROUTE)
-        fiware.insert_data(routes, content_type=ROUTE)
-        routes_cb = fiware.get_data(content_type=ROUTE)['contextResponses']
-        print 'Done:', len(routes_cb)
-        # STOPS
-        print '> Inserting Stops...    ',
-        stops = crawler.get_data_by_agency(agency_id, content_type=STOP)
-        fiware.insert_data(stops, content_type=STOP)
-        stops_cb = fiware.get_data(content_type=STOP)['contextResponses']
-        print 'Done:', len(stops_cb)
-        # TRIPS
-        route_ids = fiware.get_ids(fiware.get_data(content_type=ROUTE))
-        print '> Inserting Trips...    ',
-        trips = crawler.get_data_from_routes(route_ids, content_type=TRIP)
-        fiware.insert_data(trips, content_type=TRIP)
-        trips_cb = fiware.get_data(content_type=TRIP)['contextResponses']
-        print 'Done:', len(trips_cb)
-        # STOPTIMES
-        print '> Inserting StopTimes...',
-        times = crawler.get_data_from_routes(route_ids, content_type=STOPTIME)
-        fiware.insert_data(times, content_type=STOPTIME)
-        times_cb = fiware.get_data(content_type=STOPTIME)['contextResponses']
-        print 'Done:', len(times_cb)
-    except (APIKeyError, CrawlerError, OSTError, FiWareError) as error:
-        message = get_error_message(error)
-        print(Fore.RED + str(error) + Fore.RESET + ':' + message)
+        push_data(fiware, agency, AGENCY, sync_state)
+        report_stage(AGENCY, fiware, crawler)
+        if checkpoints is not None:
+            checkpoints.finish_stage(run, AGENCY, agency.get(ID))
+        return agency.get(ID)
+    except STAGE_ERRORS as error:
+        report_error(error)
+        raise
+
+
+@task(name='import_routes_cb', ignore_result=True)
+def import_routes(agency_id, delta=FIWARE_DELTA_SYNC, run=None):
+    """
+      Imports the Agency's Routes, returning the ids of the
+      crawled Routes for the Trips and StopTimes stages.
+    """
+    checkpoints = get_checkpoints(run)
+    if is_imported(checkpoints, run, ROUTE):
+        return checkpoints.get_result(run, ROUTE)
+    try:
+        crawler = Crawler()
+        fiware = FiWare()
+        sync_state = SyncState() if delta else None
+        print '> Inserting Routes...'
+        route_ids = []
+        routes = crawler.iter_data_by_agency(agency_id, content_type=ROUTE)
+        push_data(fiware, collect_ids(routes, route_ids), ROUTE, sync_state)
+        report_stage(ROUTE, fiware, crawler)
+        if checkpoints is not None:
+            checkpoints.finish_stage(run, ROUTE, route_ids)
+        return route_ids
+    except STAGE_ERRORS as error:
+        report_error(error)
+        raise
+
+
+@task(name='import_stops_cb', ignore_result=True)
+def import_stops(agency_id, delta=FIWARE_DELTA_SYNC, run=None):
+    """ Imports the Agency's Stops (independent of its Routes) """
+    checkpoints = get_checkpoints(run)
+    if is_imported(checkpoints, run, STOP):
+        return
+    try:
+        crawler = Crawler()
+        fiware = FiWare()
+        sync_state = SyncState() if delta else None
+        print '> Inserting Stops...'
+        stops = crawler.iter_data_by_agency(agency_id, content_type=STOP)
+        push_data(fiware, stops, STOP, sync_state)
+        report_stage(STOP, fiware, crawler)
+        if checkpoints is not None:
+            checkpoints.finish_stage(run, STOP)
+    except STAGE_ERRORS as error:
+        report_error(error)
+        raise
+
+
+def get_chunks(items, size=ROUTES_CHUNK_SIZE):
+    """ Splits a list into lists of up to size items """
+    return [items[index:index + size] for index in xrange(0, len(items), size)]
+
+
+@task(name='import_route_data_cb', ignore_result=True)
+def import_route_data(route_ids, content_type, delta=FIWARE_DELTA_SYNC,
+                      run=None):
+    """
+      Imports the Trips or StopTimes of a list of Routes, fanned out
+      to one subtask per chunk of Routes (so that every worker node
+      takes part). A callback aggregates the chunks' results.
+      With delta sync the chunks run in this task instead: the sync
+      state is a file of this host, where they're staged and committed.
+    """
+    checkpoints = get_checkpoints(run)
+    if is_imported(checkpoints, run, content_type):
+        return
+    resumed = checkpoints is not None and \
+        checkpoints.has_cursors(run, content_type)
+    if delta and not resumed:
+        # A resumed stage keeps what its imported routes staged
+        SyncState().reset(content_type)
+    chunks = get_chunks(route_ids)
+    print '> Inserting {}s of {} Routes in {} subtasks...'.format(
+        content_type,
+        len(route_ids),
+        len(chunks),
+    )
+    if delta or not chunks:
+        results = [
+            import_routes_chunk(chunk, content_type, delta=delta, run=run)
+            for chunk in chunks
+        ]
+        return aggregate_route_data(results, content_type, delta=delta,
+                                    run=run)
+    callback = aggregate_route_data.s(content_type, delta=delta, run=run)
+    return chord(
+        import_routes_chunk.s(chunk, content_type, delta=delta, run=run)
+        for chunk in chunks
+    )(callback)
+
+
+def import_route_pages(route_id, content_type, crawler, fiware,
+                       sync_state=None, checkpoints=None, run=None):
+    """
+      Imports the Trips or StopTimes of a Route page by page. With
+      checkpoints, the next page is recorded once a page is in the
+      ContextBroker and a resumed run starts from it.
+    """
+    cursor = None
+    if checkpoints is not None:
+        cursor = checkpoints.get_cursor(run, content_type, route_id)
+    if cursor == FINISHED:
+        return
+    api_url = cursor or crawler.get_route_url(route_id, content_type)
+    for elements, next_url in crawler.iter_pages(api_url):
+        if sync_state is not None:
+            elements = sync_state.diff(elements, content_type, reset=False)
+        # Routes are imported concurrently, one request in flight each
+        fiware.insert_data(elements, content_type=content_type, workers=1)
+        if checkpoints is not None:
+            checkpoints.set_cursor(run, content_type, route_id, next_url)
+
+
+@task(name='import_routes_chunk_cb')
+def import_routes_chunk(route_ids, content_type, delta=FIWARE_DELTA_SYNC,
+                        run=None):
+    """
+      Imports the Trips or StopTimes of a chunk of Routes, up to
+      CRAWLER_WORKERS Routes at a time. Errors are returned (not
+      raised) so that the other chunks' results still reach the
+      callback.
+    """
+    result = {
+        'routes': len(route_ids),
+        'entities': 0,
+        'failed': 0,
+        'changed': 0,
+        'requests': 0,
+        'parsing': 0.0,
+        'serializing': 0.0,
+        'errors': [],
+    }
+    crawler = Crawler()
+    fiware = FiWare()
+    sync_state = SyncState() if delta else None
+    import_route = partial(
+        import_route_pages,
+        content_type=content_type,
+        crawler=crawler,
+        fiware=fiware,
+        sync_state=sync_state,
+        checkpoints=get_checkpoints(run),
+        run=run,
+    )
+    try:
+        for _ in imap_bounded(import_route, route_ids, crawler.workers):
+            pass
+        if sync_state is not None:
+            result['changed'] = sync_state.changed.get(content_type, 0)
+    except STAGE_ERRORS as error:
+        result['errors'].append((str(error), get_error_message(error)))
+    result['entities'] = fiware.stats['entities']
+    result['failed'] = fiware.stats['errors']
+    result['requests'] = crawler.stats['requests']
+    result['parsing'] = crawler.stats['parsing']
+    result['serializing'] = fiware.stats['serializing']
+    return result
+
+
+@task(name='aggregate_route_data_cb', ignore_result=True)
+def aggregate_route_data(results, content_type, delta=FIWARE_DELTA_SYNC,
+                         run=None):
+    """
+      Chord callback: reports the totals of the chunks of a stage.
+      The stage is marked as synced (and imported, for the run's
+      checkpoints) only if every chunk succeeded.
+    """
+    totals = Counter()
+    errors = []
+    for result in results:
+        errors.extend(result.pop('errors'))
+        totals.update(result)
+    print '> {}: {} entities from {} Routes ({} failed), ' \
+        '{} OST requests. JSON: {:.1f}s parsing, {:.1f}s serializing'.format(
+            content_type,
+            totals['entities'],
+            totals['routes'],
+            totals['failed'],
+            totals['requests'],
+            totals['parsing'],
+            totals['serializing'],
+        ),
+    if delta and not errors:
+        removed = SyncState().commit(content_type)
+        print '({} changed, {} removed)'.format(
+            totals['changed'],
+            len(removed),
+        ),
+    print
+    for name, message in errors:
+        print(Fore.RED + name + Fore.RESET + ':' + message)
+    if run and not errors:
+        Checkpoints().finish_stage(run, content_type)
+    return dict(totals, errors=len(errors))
+
+
+def get_workflow(agency_name=None, delta=FIWARE_DELTA_SYNC, run=None):
+    """
+      Returns the import as a graph of stages. Each stage gets
+      what it needs from the previous one (the Agency's id, the
+      crawled Route ids) and independent stages run concurrently:
+
+        Agency -+-> Routes -+-> Trips
+                |           +-> StopTimes
+                +-> Stops
+
+      Stages of a run record their progress, skipping what the
+      run already imported.
+    """
+    route_data = group(
+        import_route_data.s(content_type=TRIP, delta=delta, run=run),
+        import_route_data.s(content_type=STOPTIME, delta=delta, run=run),
+    )
+    return chain(
+        import_agency.s(agency_name, delta=delta, run=run),
+        group(
+            chain(import_routes.s(delta=delta, run=run), route_data),
+            import_stops.s(delta=delta, run=run),
+        ),
+    )
+
+
+@task(name='transfer_gtfs_cb', ignore_result=True)
+def transfer_gtfs_cb(agency_name=None, delta=FIWARE_DELTA_SYNC, resume=True):
+    """
+      Fetches CP data from OST APIs and puts it on ContextBroker
+      Uses the Crawler to fetch data and FiWare to import it.
+      The stages (see get_workflow) are sent to the workers:
+      # 1st) Agency == CP
+      # 2nd) CP Routes and CP Stops
+      # 3rd) CP Trips and CP StopTimes (of the crawled Routes,
+      #      in chunks of ROUTES_CHUNK_SIZE Routes per subtask)
+      If delta is True only what changed since the last run is sent.
+      If the last run failed (less than FIWARE_CHECKPOINTS_MAX_AGE
+      ago) it's resumed from its checkpoints, unless resume is False.
+    """
+    agency = agency_name or CP_NAME
+    checkpoints = Checkpoints()
+    if not resume:
+        checkpoints.forget_runs(agency)
+    run, started_at = checkpoints.begin(agency)
+    if started_at is not None:
+        print '> Resuming the import started at', time.ctime(started_at)
+    return get_workflow(agency_name, delta, run).apply_async()
 
 if __name__ == '__main__':
-    transfer_gtfs_cb()
+    # Without workers, run the stages in this process (in order)
+    current_app.conf.CELERY_ALWAYS_EAGER = True
+    try:
+        transfer_gtfs_cb()
+    except STAGE_ERRORS:
+        # Already reported by the stage that failed
+        pass
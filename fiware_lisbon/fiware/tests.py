@@ -1,16 +1,53 @@
+import os
+import shutil
+import tempfile
+import time
 import unittest
+import zipfile
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
 import requests
 import simplejson
 
 from utils.constants import AGENCY
 from utils.constants import CP_NAME
+from utils.constants import FIWARE_GOOD_STATUS
 from utils.constants import FIWARE_HOST
 from utils.constants import OST_API_KEY
 from utils.constants import OST_API_MAIN_URL
+from utils.constants import ROUTE
+from utils.constants import STOP
+from utils.constants import TRIP
+from utils.constants import UNKNOWN_ADDRESS
+from utils.errors import CrawlerError
+from utils.errors import FiWareError
+from utils.errors import OSTError
 from utils.utils import get_ost_api
+from cache import ResponseCache
 from crawler import Crawler
+from checkpoints import Checkpoints
+from checkpoints import FINISHED
+from delta import SyncState
+from serializer import ElementSerializer
 from importer import FiWare
+from backends import get_backend
+from ckan.boundaries import Boundaries
+from ckan.deferred import DeferredPlaces
+from ckan.geocache import GeocodeCache
+from ckan.geocoders import GeocoderPool
+from ckan.geocoders import Provider
+from geopy.exc import GeocoderQuotaExceeded
+from geopy.exc import GeocoderTimedOut
+from utils.throttle import CircuitBreaker
+from utils.flatten import CSVWriter
+from utils.flatten import records_to_csv
+from utils.download import DownloadError
+from utils.download import PART_SUFFIX
+from utils.download import VALIDATOR_SUFFIX
+from utils.download import check_zip
+from utils.download import download
+from utils.utils import to_keyvalue_pairs
 
 
 class TestConstants(unittest.TestCase):
@@ -72,5 +109,838 @@ class TestConstants(unittest.TestCase):
         self.assertTrue(str(agency['id']) in agency_ids)
 
 
+class FakeResponse(object):
+    """ Minimal stand-in for a requests.Response """
+
+    def __init__(self, url, content, status_code=200, headers=None):
+        self.url = url
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeOSTSession(object):
+    """ Serves OST-like pages from a dictionary of URL: (objects, next) """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requested.append(url)
+        objects, next_page = self.pages[url]
+        content = simplejson.dumps({
+            'Objects': objects,
+            'Meta': {'next_page': next_page},
+        })
+        if headers and headers.get('If-None-Match') == '"v1"':
+            return FakeResponse(url, '', status_code=304)
+        return FakeResponse(url, content, headers={'ETag': '"v1"'})
+
+
+class FakeOrionSession(object):
+    """
+      Answers updateContext requests, failing the given entity ids,
+      and paginated queryContext requests over the given entity ids
+    """
+
+    def __init__(self, failing_ids=(), entity_ids=()):
+        self.failing_ids = failing_ids
+        self.entity_ids = list(entity_ids)
+        self.payloads = []
+        self.queries = []
+
+    def query(self, url, params):
+        self.queries.append(params)
+        offset, limit = params['offset'], params['limit']
+        page = self.entity_ids[offset:offset + limit]
+        if not page:
+            error = {'code': '404', 'reasonPhrase': 'No context element found'}
+            return FakeResponse(url, simplejson.dumps({'errorCode': error}))
+        content = {'contextResponses': [{
+            'contextElement': {'id': each, 'attributes': []},
+            'statusCode': FIWARE_GOOD_STATUS,
+        } for each in page]}
+        if params.get('details') == 'on':
+            content['errorCode'] = {
+                'code': '200',
+                'details': 'Count: {}'.format(len(self.entity_ids)),
+                'reasonPhrase': 'OK',
+            }
+        return FakeResponse(url, simplejson.dumps(content))
+
+    def post(self, url, data=None, params=None, **kwargs):
+        payload = simplejson.loads(data)
+        if 'entities' in payload:
+            return self.query(url, params)
+        self.payloads.append(payload)
+        context_responses = []
+        for element in payload['contextElements']:
+            status = FIWARE_GOOD_STATUS
+            if element['id'] in self.failing_ids:
+                status = {'code': '472', 'reasonPhrase': 'bad attribute'}
+            context_responses.append({
+                'contextElement': {'id': element['id']},
+                'statusCode': status,
+            })
+        content = simplejson.dumps({'contextResponses': context_responses})
+        return FakeResponse(url, content)
+
+
+class FakeOrionV2Session(object):
+    """ Answers NGSIv2 batch updates and paginated entity queries """
+
+    def __init__(self, entity_ids=()):
+        self.entity_ids = [unicode(each) for each in entity_ids]
+        self.payloads = []
+
+    def post(self, url, data=None, params=None, **kwargs):
+        self.payloads.append((params, simplejson.loads(data)))
+        return FakeResponse(url, '', status_code=204)
+
+    def get(self, url, params=None, **kwargs):
+        offset, limit = params['offset'], params['limit']
+        entities = [{'id': each, 'type': params['type']}
+                    for each in self.entity_ids[offset:offset + limit]]
+        headers = {}
+        if 'count' in params['options']:
+            headers['Fiware-Total-Count'] = str(len(self.entity_ids))
+        return FakeResponse(url, simplejson.dumps(entities), headers=headers)
+
+
+class TestCrawler(unittest.TestCase):
+    """ TestCase for the Crawler's behaviour without reaching OST """
+
+    def test_iter_pages_is_lazy(self):
+        # Pages are only requested when the previous one was consumed
+        first_url = OST_API_MAIN_URL + 'trips?key=x'
+        session = FakeOSTSession({
+            first_url: ([1, 2], 'trips?key=x&page=2'),
+            first_url + '&page=2': ([3], None),
+        })
+        crawler = Crawler(workers=1, session=session, prefetch=False)
+        elements = crawler.iter_data_from_url(first_url)
+        self.assertEqual(next(elements), 1)
+        self.assertEqual(len(session.requested), 1)
+        self.assertEqual(list(elements), [2, 3])
+        self.assertEqual(len(session.requested), 2)
+
+    def test_next_page_is_prefetched(self):
+        # The next page is requested before the caller asks for it
+        first_url = OST_API_MAIN_URL + 'trips?key=x'
+        session = FakeOSTSession({
+            first_url: ([1], 'trips?key=x&page=2'),
+            first_url + '&page=2': ([2], 'trips?key=x&page=3'),
+            first_url + '&page=3': ([3], None),
+        })
+        crawler = Crawler(workers=1, session=session, prefetch=True)
+        pages = crawler.iter_pages(first_url)
+        self.assertEqual(next(pages)[0], [1])
+        for _ in range(100):
+            if len(session.requested) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(session.requested), 2)
+        self.assertEqual([page for page, _ in pages], [[2], [3]])
+
+    def test_concurrent_routes_keep_order(self):
+        # Routes finishing out of order must still be returned in order
+        class SlowCrawler(Crawler):
+            def get_pages(self, api_url):
+                route_id = int(api_url.rsplit('=', 1)[1])
+                time.sleep(0.01 * (5 - route_id))
+                return [route_id, route_id]
+        crawler = SlowCrawler(workers=4)
+        trips = crawler.get_data_from_routes(range(5), content_type=TRIP)
+        self.assertEqual(trips, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+
+    def test_transient_errors_are_retried(self):
+        # OST answers 503 twice (asking to retry now) and then 200
+        url = OST_API_MAIN_URL + 'routes?key=x'
+        responses = [
+            FakeResponse(url, '', 503, {'Retry-After': '0'}),
+            FakeResponse(url, 'Temporarily Down', 200, {'Retry-After': '0'}),
+            FakeResponse(url, '{"Objects": [1], "Meta": {}}'),
+        ]
+
+        class FlakySession(object):
+            def get(self, url, **kwargs):
+                return responses.pop(0)
+        crawler = Crawler(workers=1, session=FlakySession())
+        self.assertEqual(crawler.get_pages(url), [1])
+        self.assertEqual(crawler.stats['retries'], 2)
+        self.assertEqual(crawler.stats['retries_maintenance'], 1)
+
+    def test_retries_are_limited_per_error_class(self):
+        url = OST_API_MAIN_URL + 'routes?key=x'
+
+        class DownSession(object):
+            def get(self, url, **kwargs):
+                return FakeResponse(url, '', 502, {'Retry-After': '0'})
+        crawler = Crawler(
+            workers=1,
+            session=DownSession(),
+            retries={'server': 2},
+        )
+        self.assertRaises(OSTError, crawler.get_pages, url)
+        self.assertEqual(crawler.stats['requests'], 3)
+
+
+class TestResponseCache(unittest.TestCase):
+    """ TestCase for the Crawler's on-disk response cache """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = OST_API_MAIN_URL + 'stops?key=x&agency=1'
+        self.session = FakeOSTSession({self.url: ([{'id': 1}], None)})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_ignores_api_key(self):
+        self.assertEqual(
+            ResponseCache.get_key(self.url),
+            ResponseCache.get_key(self.url.replace('key=x', 'key=y')),
+        )
+
+    def test_stale_page_is_revalidated(self):
+        # With no TTL every page is revalidated, costing a 304
+        cache = ResponseCache(self.directory, ttl=0)
+        crawler = Crawler(workers=1, session=self.session, cache=cache)
+        self.assertEqual(crawler.get_pages(self.url), [{'id': 1}])
+        self.assertEqual(crawler.get_pages(self.url), [{'id': 1}])
+        self.assertEqual(len(self.session.requested), 2)
+
+    def test_offline_replay(self):
+        online = ResponseCache(self.directory)
+        Crawler(workers=1, session=self.session, cache=online).get_pages(
+            self.url,
+        )
+        offline = ResponseCache(self.directory, offline=True)
+        crawler = Crawler(workers=1, session=self.session, cache=offline)
+        self.assertEqual(crawler.get_pages(self.url), [{'id': 1}])
+        self.assertEqual(len(self.session.requested), 1)
+        self.assertRaises(CrawlerError, crawler.get_pages, self.url + '2')
+
+
+class TestFiWare(unittest.TestCase):
+    """ TestCase for the Context Broker importer without reaching Orion """
+
+    def setUp(self):
+        self.stops = [
+            {'id': index, 'resource_uri': '/stops/{}/'.format(index)}
+            for index in range(5)
+        ]
+
+    def test_insert_data_in_batches(self):
+        session = FakeOrionSession()
+        fiware = FiWare('http://orion:1026', session=session)
+        fiware.insert_data(self.stops, content_type=STOP, batch_size=2)
+        self.assertEqual(
+            [len(payload['contextElements']) for payload in session.payloads],
+            [2, 2, 1],
+        )
+
+    def test_batch_errors_point_to_elements(self):
+        session = FakeOrionSession(failing_ids=[3])
+        fiware = FiWare('http://orion:1026', session=session)
+        with self.assertRaises(FiWareError) as context:
+            fiware.insert_data(self.stops, content_type=STOP, batch_size=2)
+        self.assertIn('3: ', context.exception.message)
+        self.assertNotIn('2: ', context.exception.message)
+
+    def test_failed_batch_does_not_stop_the_others(self):
+        session = FakeOrionSession(failing_ids=[0, 4])
+        fiware = FiWare('http://orion:1026', session=session, workers=3)
+        with self.assertRaises(FiWareError) as context:
+            fiware.insert_data(self.stops, content_type=STOP, batch_size=2)
+        self.assertEqual(len(session.payloads), 3)
+        message = context.exception.message
+        self.assertLess(message.index('0: '), message.index('4: '))
+        self.assertEqual(fiware.stats['entities'], 5)
+        self.assertEqual(fiware.stats['errors'], 2)
+
+    def test_queries_are_paginated(self):
+        session = FakeOrionSession(entity_ids=range(5))
+        fiware = FiWare('http://orion:1026', session=session)
+        self.assertEqual(list(fiware.iter_ids(STOP, page_size=2)), range(5))
+        self.assertEqual([query['offset'] for query in session.queries],
+                         [0, 2, 4])
+        self.assertEqual(len(fiware.get_data(STOP)['contextResponses']), 5)
+        self.assertEqual(fiware.count(STOP), 5)
+        self.assertEqual(FiWare('http://orion:1026',
+                                session=FakeOrionSession()).count(STOP), 0)
+
+    def test_ngsiv2_backend(self):
+        session = FakeOrionV2Session(entity_ids=range(3))
+        fiware = FiWare('http://orion:1026', session=session,
+                        backend=get_backend('http://orion:1026', 'v2'))
+        stops = [{
+            'id': 1,
+            'resource_uri': '/stops/1/',
+            'stop_name': 'Oriente (Gare)',
+            'point': {'type': 'Point', 'coordinates': [-9.1, 38.7]},
+            'agency': {'id': 2, 'resource_uri': '/agencies/2/'},
+        }]
+        fiware.insert_data(stops, content_type=STOP)
+        params, payload = session.payloads[0]
+        self.assertEqual(params, {'options': 'keyValues'})
+        self.assertEqual(payload, {'actionType': 'append', 'entities': [{
+            'id': '1',
+            'type': STOP,
+            'stop_name': 'Oriente %28Gare%29',
+            'coordinates': '38.7,-9.1',
+            'agency': 2,
+        }]})
+        self.assertEqual(list(fiware.iter_ids(STOP, page_size=2)),
+                         ['0', '1', '2'])
+        self.assertEqual(fiware.count(STOP), 3)
+
+    def test_serializer_matches_wrap_element(self):
+        # Compiled serialization must give the same contextElements,
+        # including for elements that don't follow the first's layout
+        stops = [{
+            'id': index,
+            'resource_uri': '/stops/{}/'.format(index),
+            'stop_name': u'Esta\xe7\xe3o {}'.format(index),
+            'point': {'type': 'Point', 'coordinates': [-9.1, 38.7]},
+            'agency': {'resource_uri': '/agencies/1/'},
+        } for index in range(4)]
+        stops[2]['stop_name'] = None
+        stops[3]['agency'] = {'id': 2}
+        serializer = ElementSerializer(STOP, FiWare.wrap_element)
+        for stop in stops:
+            expected = FiWare.wrap_element(dict(stop), STOP)
+            element_id, element = serializer.serialize(stop)
+            element = simplejson.loads(element)
+            self.assertEqual(element_id, expected['id'])
+            self.assertEqual(
+                sorted(element['attributes']),
+                sorted(expected['attributes']),
+            )
+
+
+class TestSyncState(unittest.TestCase):
+    """ TestCase for the delta sync between OST and the Context Broker """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = SyncState(self.directory + '/sync.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_changes_are_synced(self):
+        stops = [
+            {'id': 1, 'stop_name': 'Oriente'},
+            {'resource_uri': '/stops/2/', 'stop_name': 'Rossio'},
+        ]
+        self.assertEqual(list(self.state.diff(stops, STOP)), stops)
+        self.assertEqual(self.state.commit(STOP), [])
+        # Second run: one stop changed, one removed and one added
+        stops = [
+            {'id': 1, 'stop_name': 'Lisboa Oriente'},
+            {'id': 3, 'stop_name': 'Cais do Sodre'},
+        ]
+        self.assertEqual(list(self.state.diff(stops, STOP)), stops)
+        self.assertEqual(self.state.commit(STOP), ['2'])
+        # Third run: nothing changed
+        self.assertEqual(list(self.state.diff(stops, STOP)), [])
+        self.assertEqual(self.state.changed[STOP], 0)
+
+    def test_uncommitted_changes_are_sent_again(self):
+        stops = [{'id': 1, 'stop_name': 'Oriente'}]
+        list(self.state.diff(stops, STOP))
+        self.assertEqual(list(self.state.diff(stops, STOP)), stops)
+
+    def test_staged_in_parts(self):
+        # Subtasks stage chunks of the same type into one commit
+        stops = [{'id': index} for index in range(1, 5)]
+        self.state.reset(STOP)
+        for chunk in (stops[:2], stops[2:]):
+            list(self.state.diff(chunk, STOP, reset=False))
+        self.assertEqual(self.state.commit(STOP), [])
+        list(self.state.diff(stops[:2], STOP))
+        self.assertEqual(sorted(self.state.commit(STOP)), ['3', '4'])
+
+
+class TestCheckpoints(unittest.TestCase):
+    """ TestCase for resuming failed imports """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/checkpoints.db'
+        self.checkpoints = Checkpoints(self.path, stages=(ROUTE, TRIP))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_run_is_resumed(self):
+        run, started_at = self.checkpoints.begin(CP_NAME)
+        self.assertIsNone(started_at)
+        self.checkpoints.finish_stage(run, ROUTE, [1, 2])
+        self.checkpoints.set_cursor(run, TRIP, 1, None)
+        self.checkpoints.set_cursor(run, TRIP, 2, 'trips?page=3')
+        # The run fails, the next one resumes from its checkpoints
+        checkpoints = Checkpoints(self.path, stages=(ROUTE, TRIP))
+        resumed_run, started_at = checkpoints.begin(CP_NAME)
+        self.assertEqual(resumed_run, run)
+        self.assertIsNotNone(started_at)
+        self.assertEqual(checkpoints.get_result(run, ROUTE), [1, 2])
+        self.assertEqual(checkpoints.get_cursor(run, TRIP, 1), FINISHED)
+        self.assertEqual(checkpoints.get_cursor(run, TRIP, 2),
+                         'trips?page=3')
+        # Once complete, the next run starts over
+        checkpoints.finish_stage(run, TRIP)
+        next_run, started_at = checkpoints.begin(CP_NAME)
+        self.assertNotEqual(next_run, run)
+        self.assertIsNone(started_at)
+        self.assertFalse(checkpoints.is_done(next_run, ROUTE))
+
+    def test_old_run_starts_over(self):
+        run, _ = self.checkpoints.begin(CP_NAME)
+        self.checkpoints.finish_stage(run, ROUTE, [1])
+        checkpoints = Checkpoints(self.path, max_age=0)
+        next_run, started_at = checkpoints.begin(CP_NAME)
+        self.assertIsNone(started_at)
+        self.assertFalse(checkpoints.is_done(next_run, ROUTE))
+        self.assertFalse(checkpoints.is_done(run, ROUTE))
+
+    def test_other_hosts_older_runs_never_match(self):
+        # Another host imported the Trips of yesterday's run
+        other_host = Checkpoints(self.directory + '/other.db')
+        old_run, _ = other_host.begin(CP_NAME)
+        other_host.finish_stage(old_run, TRIP)
+        time.sleep(0.01)
+        run, _ = self.checkpoints.begin(CP_NAME)
+        self.assertFalse(other_host.is_done(run, TRIP))
+        # Which it forgets once it takes part in a newer run
+        other_host.forget_runs(CP_NAME, keep=run)
+        self.assertFalse(other_host.is_done(old_run, TRIP))
+
+
+class TestBoundaries(unittest.TestCase):
+    """ TestCase for finding parishes without asking OST """
+
+    def test_points_are_located(self):
+        # A grid of square parishes, the last one with a hole
+        features = [({
+            'type': 'Polygon',
+            'coordinates': [[[x, y], [x + 1, y], [x + 1, y + 1],
+                             [x, y + 1], [x, y]]],
+        }, {'Freguesia': '{},{}'.format(x, y), 'Concelho': 'Lisboa'})
+            for x in xrange(-20, 0) for y in xrange(30, 50)]
+        features.append(({
+            'type': 'MultiPolygon',
+            'coordinates': [[
+                [[5, 5], [9, 5], [9, 9], [5, 9], [5, 5]],
+                [[6, 6], [8, 6], [8, 8], [6, 8], [6, 6]],
+            ]],
+        }, {'Freguesia': 'Belem'}))
+        boundaries = Boundaries(features)
+        self.assertEqual(boundaries.locate_many([
+            (38.7, -9.1), (5.5, 5.5), (7, 7), (0, 0),
+        ]), [
+            ({'name': '-10,38'}, {'name': 'Lisboa'}),
+            ({'name': 'Belem'}, {}),
+            ({}, {}),
+            ({}, {}),
+        ])
+
+
+class FakeLocation(object):
+
+    def __init__(self, address):
+        self.address = address
+
+
+class FakeGeocoder(object):
+    """ Geocoder raising `error` on every call, or returning its name """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def reverse(self, coords, **kwargs):
+        self.calls += 1
+        if self.error:
+            raise self.error('Failed')
+        return FakeLocation('{} {},{}'.format(self.calls, *coords))
+
+
+class TestGeocoderPool(unittest.TestCase):
+    """ TestCase for geocoding stops with many geocoders """
+
+    def test_failing_providers_are_skipped(self):
+        over_quota = FakeGeocoder(GeocoderQuotaExceeded)
+        timing_out = FakeGeocoder(GeocoderTimedOut)
+        working = FakeGeocoder()
+        pool = GeocoderPool([
+            Provider(over_quota, 0),
+            Provider(timing_out, 0, breaker=CircuitBreaker(2, 60)),
+            Provider(working, 0, quota=3),
+        ], workers=1)
+        coords = [(38.7, -9.1)] * 4
+        self.assertEqual(
+            [provider for _, provider in pool.reverse_many(coords)],
+            ['FakeGeocoder'] * 3 + [None],
+        )
+        # Over quota once, failing until the circuit opened
+        self.assertEqual(over_quota.calls, 1)
+        self.assertEqual(timing_out.calls, 2)
+        self.assertEqual(working.calls, 3)
+
+    def test_quota_is_kept_across_runs(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = GeocodeCache(directory + '/geocode.db')
+            working = FakeGeocoder()
+            pool = GeocoderPool(
+                [Provider(working, 0, quota=3, usage=cache)],
+                workers=1,
+            )
+            self.assertEqual(pool.reverse((38.7, -9.1))[1], 'FakeGeocoder')
+            # Another run (or worker) shares the day's requests
+            pool = GeocoderPool([Provider(
+                working,
+                0,
+                quota=3,
+                usage=GeocodeCache(directory + '/geocode.db'),
+            )], workers=1)
+            coords = [(38.7, -9.1)] * 3
+            self.assertEqual(
+                [provider for _, provider in pool.reverse_many(coords)],
+                ['FakeGeocoder'] * 2 + [None],
+            )
+            self.assertEqual(working.calls, 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_quota_is_reserved_atomically(self):
+        directory = tempfile.mkdtemp()
+        try:
+            providers = [
+                Provider(FakeGeocoder(), 0, quota=5),
+                Provider(
+                    FakeGeocoder(),
+                    0,
+                    quota=5,
+                    usage=GeocodeCache(directory + '/geocode.db'),
+                ),
+            ]
+            for provider in providers:
+                reserved = ThreadPool(8).map(
+                    lambda _: provider.try_acquire(),
+                    xrange(40),
+                )
+                self.assertEqual(reserved.count(True), 5)
+                self.assertEqual(provider.used, 5)
+                self.assertFalse(provider.is_available())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFlatten(unittest.TestCase):
+    """ TestCase for writing records as flat CSV rows """
+
+    def test_rows_match_to_keyvalue_pairs(self):
+        records = [{
+            '_id': index,
+            'id': index,
+            'stop': {'id': index % 3, 'name': u'Esta\xe7\xe3o'},
+            'coordinates': [-9.1, 38.7],
+        } for index in xrange(5)]
+        # A record missing nested values
+        records.append({'id': 5, 'stop': None})
+        output_file = StringIO()
+        self.assertEqual(
+            records_to_csv(iter(records), output_file, sample_size=2),
+            6,
+        )
+        rows = output_file.getvalue().splitlines()
+        columns = sorted(dict(to_keyvalue_pairs(records[0])))
+        self.assertEqual(rows[0].split(','), columns)
+        self.assertEqual(rows[1], '-9.1,38.7,0,0,Esta\xc3\xa7\xc3\xa3o')
+        self.assertEqual(rows[-1], ',,5,,')
+
+    def test_nested_values_are_json(self):
+        schema = [('id', ('id',)), ('shape', ('shape',))]
+        records = [
+            {'id': 1, 'shape': [-9.1, 38.7]},
+            {'id': 2, 'shape': {'type': 'Point'}},
+            {'id': 3},
+        ]
+        output_file = StringIO()
+        CSVWriter(output_file, schema).write_records(records)
+        self.assertEqual(output_file.getvalue().splitlines(), [
+            'id,shape',
+            '1,"[-9.1,38.7]"',
+            '2,"{""type"":""Point""}"',
+            '3,',
+        ])
+
+
+class FakeDownloadResponse(FakeResponse):
+    """ Response streamed in chunks, like requests' with stream=True """
+
+    def iter_content(self, chunk_size):
+        for index in xrange(0, len(self.content), chunk_size):
+            yield self.content[index:index + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeDownloadSession(object):
+    """
+      Serves a file with an ETag, honouring Range requests whose
+      If-Range matches it (unless ranges is False, or from byte 0
+      if misaligned) and closing the first `cuts` connections halfway
+    """
+
+    def __init__(self, content, ranges=True, cuts=0, etag='"v1"',
+                 misaligned=False):
+        self.content = content
+        self.ranges = ranges
+        self.cuts = cuts
+        self.etag = etag
+        self.misaligned = misaligned
+        self.requested = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requested.append(headers.get('Range'))
+        offset = 0
+        if self.ranges and 'Range' in headers and \
+                headers.get('If-Range') == self.etag:
+            offset = int(headers['Range'][len('bytes='):-1])
+            if offset >= len(self.content):
+                return FakeDownloadResponse(url, '', status_code=416)
+        status_code = 206 if offset else 200
+        if self.misaligned:
+            offset = 0
+        body = self.content[offset:]
+        response_headers = {
+            'content-length': str(len(body)),
+            'etag': self.etag,
+        }
+        if status_code == 206:
+            response_headers['content-range'] = 'bytes {}-{}/{}'.format(
+                offset,
+                len(self.content) - 1,
+                len(self.content),
+            )
+        if self.cuts:
+            self.cuts -= 1
+            body = body[:len(body) // 2]
+        return FakeDownloadResponse(
+            url,
+            body,
+            status_code=status_code,
+            headers=response_headers,
+        )
+
+
+class TestDownload(unittest.TestCase):
+    """ TestCase for streaming GTFS archives to disk """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/gtfs.zip'
+        self.content = ''.join(chr(index % 256) for index in xrange(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_part(self, content, validator='"v1"'):
+        """ Leaves a partial download, as an interrupted run does """
+        with open(self.path + PART_SUFFIX, 'wb') as part_file:
+            part_file.write(content)
+        if validator:
+            validator_path = self.path + PART_SUFFIX + VALIDATOR_SUFFIX
+            with open(validator_path, 'w') as validator_file:
+                validator_file.write(validator)
+
+    def test_interrupted_download_is_resumed(self):
+        session = FakeDownloadSession(self.content, cuts=1)
+        self.assertEqual(download('gtfs', self.path, session, 64), 1000)
+        self.assertEqual(session.requested, [None, 'bytes=500-'])
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+        self.assertEqual(os.listdir(self.directory), ['gtfs.zip'])
+
+    def test_ignored_range_starts_over(self):
+        self.write_part(self.content[:300])
+        session = FakeDownloadSession(self.content, ranges=False)
+        self.assertEqual(download('gtfs', self.path, session), 1000)
+        self.assertEqual(session.requested, ['bytes=300-'])
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_newer_file_starts_over(self):
+        # Left by the previous night's run
+        self.write_part('old feed', validator='"v0"')
+        session = FakeDownloadSession(self.content)
+        self.assertEqual(download('gtfs', self.path, session), 1000)
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_part_of_unknown_version_is_removed(self):
+        self.write_part(self.content[:300], validator=None)
+        session = FakeDownloadSession(self.content)
+        self.assertEqual(download('gtfs', self.path, session), 1000)
+        self.assertEqual(session.requested, [None])
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_misaligned_range_starts_over(self):
+        self.write_part(self.content[:300])
+        session = FakeDownloadSession(self.content, misaligned=True)
+        self.assertEqual(download('gtfs', self.path, session), 1000)
+        self.assertEqual(session.requested, ['bytes=300-', None])
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_stale_part_is_removed_on_416(self):
+        self.write_part(self.content + 'stale')
+        session = FakeDownloadSession(self.content)
+        self.assertEqual(download('gtfs', self.path, session), 1000)
+        self.assertEqual(session.requested, ['bytes=1005-', None])
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_retries_are_limited(self):
+        session = FakeDownloadSession(self.content, ranges=False, cuts=3)
+        self.assertRaises(
+            DownloadError,
+            download, 'gtfs', self.path, session, retries=2,
+        )
+        self.assertEqual(len(session.requested), 3)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_corrupt_zip_is_removed(self):
+        with zipfile.ZipFile(self.path, 'w') as zip_file:
+            zip_file.writestr('stops.txt', 'stop_id,stop_name\n1,Rossio\n')
+        check_zip(self.path)
+        content = open(self.path, 'rb').read()
+        with open(self.path, 'wb') as zip_file:
+            zip_file.write(content.replace('Rossio', 'Russia'))
+        self.assertRaises(DownloadError, check_zip, self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestGeocodeCache(unittest.TestCase):
+    """ TestCase for the cache of reverse geocoded addresses """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = GeocodeCache(
+            self.directory + '/geocode.db',
+            ttl=60,
+            precision=5,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_nearby_coords_share_an_address(self):
+        self.assertIsNone(self.cache.get((38.7139, -9.1394)))
+        self.cache.set((38.7139, -9.1394), 'Rossio', 'GoogleV3')
+        self.assertEqual(self.cache.get((38.713901, -9.139401)), 'Rossio')
+        self.assertIsNone(self.cache.get((38.7140, -9.1394)))
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['misses'], 2)
+
+    def test_old_addresses_expire(self):
+        self.cache.set((38.7139, -9.1394), 'Rossio', 'GoogleV3')
+        self.cache.connection.execute(
+            'UPDATE addresses SET updated_at = ?',
+            (time.time() - 61,),
+        )
+        self.assertIsNone(self.cache.get((38.7139, -9.1394)))
+        self.assertEqual(self.cache.stats['expired'], 1)
+        self.cache.set((38.7139, -9.1394), 'Rossio', 'Nominatim')
+        self.assertEqual(self.cache.get((38.7139, -9.1394)), 'Rossio')
+
+    def test_warm_keeps_cached_addresses(self):
+        self.cache.set((38.7139, -9.1394), 'Rossio', 'GoogleV3')
+        places = [{
+            'field_location_latitude': 38.7139,
+            'field_location_longitude': -9.1394,
+            'field_location_address_first_line': 'Praca D. Pedro IV',
+        }, {
+            'field_location_latitude': 38.7678,
+            'field_location_longitude': -9.0990,
+            'field_location_address_first_line': 'Oriente',
+        }, {
+            'field_location_latitude': 38.7223,
+            'field_location_longitude': -9.1393,
+            'field_location_address_first_line': '',
+        }, {
+            'field_location_latitude': 38.7369,
+            'field_location_longitude': -9.1427,
+            'field_location_address_first_line': UNKNOWN_ADDRESS,
+        }]
+        self.assertEqual(self.cache.warm(places), 1)
+        self.assertIsNone(self.cache.get((38.7369, -9.1427)))
+        self.assertEqual(self.cache.get((38.7139, -9.1394)), 'Rossio')
+        self.assertEqual(self.cache.get((38.7678, -9.0990)), 'Oriente')
+        self.assertIsNone(self.cache.get((38.7223, -9.1393)))
+        self.assertEqual(self.cache.stats['warmed'], 1)
+
+    def test_unknown_address_is_never_a_hit(self):
+        self.cache.set((38.7139, -9.1394), UNKNOWN_ADDRESS, 'GoogleV3')
+        self.assertIsNone(self.cache.get((38.7139, -9.1394)))
+        # Cached by an older run
+        self.cache.connection.execute(
+            'INSERT INTO addresses VALUES (?, ?, ?, ?)',
+            (self.cache.get_key((38.7139, -9.1394)), UNKNOWN_ADDRESS,
+             'previous run', time.time()),
+        )
+        self.assertIsNone(self.cache.get((38.7139, -9.1394)))
+        self.assertEqual(self.cache.stats['hits'], 0)
+
+
+class TestDeferredPlaces(unittest.TestCase):
+    """ TestCase for the queue of Places waiting for an address """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.deferred = DeferredPlaces(self.directory + '/deferred.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_least_attempted_places_come_first(self):
+        self.deferred.add('stops', [(1, (38.71, -9.13)), (2, (38.72, -9.14))])
+        self.deferred.record_attempt('stops', [1])
+        # Queued again by the next import, keeping its attempts
+        self.deferred.add('stops', [(1, (38.71, -9.13)), (3, (38.73, -9.15))])
+        self.deferred.record_attempt('stops', [3, 3])
+        self.deferred.record_attempt('stops', [3])
+        self.assertEqual(self.deferred.count(), 3)
+        self.assertEqual(self.deferred.get_pending(10), [
+            ('stops', '2', (38.72, -9.14)),
+            ('stops', '1', (38.71, -9.13)),
+            ('stops', '3', (38.73, -9.15)),
+        ])
+        self.assertEqual(len(self.deferred.get_pending(2)), 2)
+
+    def test_oldest_places_come_first(self):
+        self.deferred.add('stops', [(2, (38.72, -9.14))])
+        self.deferred.connection.execute(
+            'UPDATE places SET added_at = added_at - 60',
+        )
+        self.deferred.add('other stops', [(1, (38.71, -9.13))])
+        self.assertEqual(
+            [poi_id for _, poi_id, _ in self.deferred.get_pending(10)],
+            ['2', '1'],
+        )
+
+    def test_resolved_places_are_removed(self):
+        self.deferred.add('stops', [(1, (38.71, -9.13)), (2, (38.72, -9.14))])
+        self.deferred.add('other stops', [(1, (38.71, -9.13))])
+        self.deferred.remove('stops', [1])
+        self.assertEqual(
+            sorted((resource_id, poi_id) for resource_id, poi_id, _
+                   in self.deferred.get_pending(10)),
+            [('other stops', '1'), ('stops', '2')],
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
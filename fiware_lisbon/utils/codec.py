@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+  JSON codec used for OST pages, ContextBroker payloads and CKAN calls.
+  The fastest available backend is picked at import:
+  - Decoding: ujson, then simplejson (with its C speedups) and json
+  - Encoding: json, whose C encoder is as fast as simplejson's (ujson
+    rounds floats or adds noise to them, e.g. 38.700000000000003)
+  Run `python benchmarks.py codec` to compare them.
+"""
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+# Compact separators make smaller payloads
+encode = json.JSONEncoder(separators=(',', ':')).encode
+DUMPS_BACKEND = 'json'
+
+if ujson is not None:
+    LOADS_BACKEND = 'ujson'
+
+    def loads(string):
+        """ Decodes a JSON string """
+        return ujson.loads(string, precise_float=True)
+elif simplejson is not None:
+    LOADS_BACKEND = 'simplejson'
+    loads = simplejson.JSONDecoder().decode
+else:
+    LOADS_BACKEND = 'json'
+    loads = json.JSONDecoder().decode
+
+
+def dumps(content):
+    """ Encodes content as compact JSON """
+    return encode(content)
@@ -57,6 +57,21 @@ CKAN_DATASET_FIELDS = [
     {"id": "field_location_city", "type": "text"},
     {"id": "field_location_country", "type": "text"}
 ]
+PLACES_PRIMARY_KEY = 'field_poi_id'
+
+# Records per datastore_upsert request and maximum payload size, requests
+# sent at the same time and retries of a failed batch per kind of error
+CKAN_BATCH_SIZE = int(os.environ.get('CKAN_BATCH_SIZE', 1000))
+CKAN_BATCH_BYTES = 5 * 1000 * 1000
+CKAN_WORKERS = int(os.environ.get('CKAN_WORKERS', 4))
+CKAN_RETRIES = {
+    'connection': 3,
+    'server': 3,
+}
+# Records per datastore_search page and resources exported at the same
+# time when pulling the GTFS back from CKAN
+CKAN_EXPORT_PAGE_SIZE = 5000
+CKAN_EXPORT_WORKERS = int(os.environ.get('CKAN_EXPORT_WORKERS', 4))
 
 
 # MyNeighbourhood constants
@@ -66,6 +81,39 @@ TRAIN = 'Train'
 PLACE_BODY = '{} {} station called {}'
 TRANSPORTATION_CATEGORY = 'Transportation'
 
+# Reverse geocoded addresses, cached by coordinates (rounded to
+# GEOCODE_PRECISION decimals) for GEOCODE_CACHE_TTL seconds
+GEOCODE_CACHE = os.environ.get('GEOCODE_CACHE', CKAN_PWD + 'geocode.db')
+GEOCODE_CACHE_TTL = int(
+    os.environ.get('GEOCODE_CACHE_TTL', 90 * 24 * 60 * 60),
+)
+GEOCODE_PRECISION = 5
+# Seed the cache with the addresses of the Places already in CKAN
+GEOCODE_CACHE_WARM = os.environ.get('GEOCODE_CACHE_WARM', 'true') == 'true'
+
+# Administrative boundaries (CAOP GeoJSON or Shapefile, in WGS84) used
+# to find the stops' parishes and municipalities without asking OST
+CAOP_BOUNDARIES = os.environ.get('CAOP_BOUNDARIES')
+CAOP_PARISH_FIELD = os.environ.get('CAOP_PARISH_FIELD', 'Freguesia')
+CAOP_MUNICIPALITY_FIELD = os.environ.get('CAOP_MUNICIPALITY_FIELD', 'Concelho')
+
+# Reverse geocoders queried at the same time: requests per second and
+# per day of each (0 = no quota), stops geocoded concurrently, and the
+# failures in a row after which a geocoder is left alone for a while
+GOOGLE_GEOCODER_RATE = float(os.environ.get('GOOGLE_GEOCODER_RATE', 10))
+GOOGLE_GEOCODER_QUOTA = int(os.environ.get('GOOGLE_GEOCODER_QUOTA', 2500))
+NOMINATIM_RATE = float(os.environ.get('NOMINATIM_RATE', 1))
+NOMINATIM_QUOTA = int(os.environ.get('NOMINATIM_QUOTA', 0))
+GEOCODER_WORKERS = int(os.environ.get('GEOCODER_WORKERS', 8))
+GEOCODER_BREAKER_THRESHOLD = 5
+GEOCODER_BREAKER_COOLDOWN = 60
+
+# Places imported without an address get UNKNOWN_ADDRESS and are queued
+# in DEFERRED_PLACES, until a geocoder finds it (DEFERRED_BATCH at a time)
+UNKNOWN_ADDRESS = 'Unknown address'
+DEFERRED_PLACES = os.environ.get('DEFERRED_PLACES', CKAN_PWD + 'deferred.db')
+DEFERRED_BATCH = int(os.environ.get('DEFERRED_BATCH', 500))
+
 ##########################################################################
 ########################     FIWARE AND OST     ##########################
 ##########################################################################
@@ -76,6 +124,37 @@ FIWARE_GOOD_STATUS = {
     'code': '200',
     'reasonPhrase': 'OK',
 }
+FIWARE_PWD = 'fiware/data/'
+# ContextBroker API: 'v1' (NGSI10) or 'v2' (NGSIv2, smaller payloads)
+FIWARE_API_VERSION = os.environ.get('FIWARE_API_VERSION', 'v1')
+
+# Elements per updateContext request and maximum payload size (Orion
+# refuses requests bigger than 1MB)
+FIWARE_BATCH_SIZE = int(os.environ.get('FIWARE_BATCH_SIZE', 100))
+FIWARE_BATCH_BYTES = 1000 * 1000
+# Entities per queryContext page (Orion's maximum is 1000)
+FIWARE_PAGE_SIZE = 1000
+# updateContext requests sent to Orion at the same time
+FIWARE_WORKERS = int(os.environ.get('FIWARE_WORKERS', 4))
+# Routes whose Trips/StopTimes are imported by each Celery subtask
+ROUTES_CHUNK_SIZE = int(os.environ.get('ROUTES_CHUNK_SIZE', 20))
+
+# Delta sync: only send entities that changed since the last run
+FIWARE_DELTA_SYNC = os.environ.get('FIWARE_DELTA_SYNC') == 'true'
+FIWARE_SYNC_STATE = os.environ.get(
+    'FIWARE_SYNC_STATE',
+    FIWARE_PWD + 'sync.db',
+)
+
+# Progress of the imports, so that a failed one resumes where it stopped
+# (unless it started more than FIWARE_CHECKPOINTS_MAX_AGE seconds ago)
+FIWARE_CHECKPOINTS = os.environ.get(
+    'FIWARE_CHECKPOINTS',
+    FIWARE_PWD + 'checkpoints.db',
+)
+FIWARE_CHECKPOINTS_MAX_AGE = int(
+    os.environ.get('FIWARE_CHECKPOINTS_MAX_AGE', 20 * 60 * 60),
+)
 
 # GTFS file names
 GTFS_RESOURCES = {
@@ -121,6 +200,30 @@ API_STOPS = get_ost_api(OST_API_MAIN_URL, 'stops', OST_API_KEY)
 API_TRIPS = get_ost_api(OST_API_MAIN_URL, 'trips', OST_API_KEY)
 API_STOPTIMES = get_ost_api(OST_API_MAIN_URL, 'stoptimes', OST_API_KEY)
 
+# Number of routes the Crawler fetches concurrently
+CRAWLER_WORKERS = int(os.environ.get('CRAWLER_WORKERS', 8))
+
+# Prefetch the next OST page and elements per page (None = API default)
+CRAWLER_PREFETCH = os.environ.get('CRAWLER_PREFETCH', 'true') == 'true'
+CRAWLER_PAGE_SIZE = int(os.environ.get('CRAWLER_PAGE_SIZE', 0)) or None
+
+# Requests per second sent to OST and retries per kind of error
+CRAWLER_RATE = float(os.environ.get('CRAWLER_RATE', 20))
+CRAWLER_RETRIES = {
+    'connection': 3,
+    'forbidden': 3,
+    'maintenance': 5,
+    'server': 5,
+    'throttled': 8,
+}
+
+# On-disk cache of OST responses (disabled if no directory is set):
+# seconds before revalidating, maximum size in bytes and offline replay
+CRAWLER_CACHE_DIR = os.environ.get('CRAWLER_CACHE_DIR')
+CRAWLER_CACHE_TTL = int(os.environ.get('CRAWLER_CACHE_TTL', 60 * 60 * 12))
+CRAWLER_CACHE_SIZE = int(os.environ.get('CRAWLER_CACHE_SIZE', 2 ** 30))
+CRAWLER_OFFLINE = os.environ.get('CRAWLER_OFFLINE') == 'true'
+
 # GTFS API Operators
 AGENCY_QUERY = '&agency={agency_id}'
 ROUTE_QUERY = '&route={route_id}'
@@ -141,6 +244,18 @@ STOP = 'Stop'
 STOPTIME = 'StopTime'
 ID = 'id'
 
+##########################################################################
+#########################     HTTP CONNECTIONS     #######################
+##########################################################################
+
+# Connections kept alive per host, (connect, read) timeouts in seconds
+# and how many times a failed connection is retried
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_TIMEOUT = (10, 120)
+HTTP_RETRIES = 3
+# Bytes read at a time when streaming downloads (e.g. GTFS archives)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 ##########################################################################
 ######################     RABBITMQ AND CELERY     #######################
 ##########################################################################
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+import re
+from zipfile import BadZipfile
+from zipfile import ZipFile
+
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError
+from requests.exceptions import Timeout
+
+from .constants import DOWNLOAD_CHUNK_SIZE
+from .constants import HTTP_RETRIES
+from .sessions import get_session
+
+
+# Suffix of the files being downloaded, renamed when complete
+PART_SUFFIX = '.part'
+# Suffix of the file holding the version (ETag or Last-Modified)
+# of the one being downloaded, so that it's only resumed if unchanged
+VALIDATOR_SUFFIX = '.validator'
+
+
+class DownloadError(IOError):
+    """ A download that couldn't be completed """
+
+
+def get_validator(response):
+    """
+      Returns the ETag (or Last-Modified) of the file being sent,
+      as If-Range takes it, or None if the server tells neither
+    """
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def get_range_start(response):
+    """ Returns the first byte of a 206 response's Content-Range """
+    match = re.match(
+        r'bytes (\d+)-',
+        response.headers.get('content-range', ''),
+    )
+    return int(match.group(1)) if match else None
+
+
+def remove_part(part_path):
+    """ Removes a partial download and its validator, if any """
+    for file_path in (part_path, part_path + VALIDATOR_SUFFIX):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def download(url, path, session=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+             retries=HTTP_RETRIES):
+    """
+      Streams an URL into a file, chunk by chunk, without holding it
+      in memory. Data is written to path + '.part', which is renamed
+      to path once complete. A '.part' file left by an interrupted
+      download is resumed with a Range request if the remote file is
+      still the version it was started with (If-Range), else the
+      server sends the whole file again. Returns the size of the file.
+    """
+    session = session or get_session(url)
+    part_path = path + PART_SUFFIX
+    validator_path = part_path + VALIDATOR_SUFFIX
+    for attempt in xrange(retries + 1):
+        validator = None
+        if os.path.exists(validator_path):
+            with open(validator_path, 'r') as validator_file:
+                validator = validator_file.read().strip() or None
+        if validator is None:
+            # Unknown version, it can't be resumed safely
+            remove_part(part_path)
+        offset = os.path.getsize(part_path) \
+            if os.path.exists(part_path) else 0
+        headers = {}
+        if offset:
+            headers = {
+                'Range': 'bytes={}-'.format(offset),
+                'If-Range': validator,
+            }
+        try:
+            response = session.get(url, headers=headers, stream=True)
+        except (ConnectionError, Timeout):
+            if attempt == retries:
+                raise
+            continue
+        try:
+            if response.status_code == 416:
+                # The partial file doesn't match the remote one anymore
+                remove_part(part_path)
+                continue
+            if response.status_code not in (200, 206):
+                raise DownloadError('HTTP {} - {}'.format(
+                    response.status_code,
+                    url,
+                ))
+            if response.status_code == 206 and \
+                    get_range_start(response) != offset:
+                # Not the bytes following the partial file
+                remove_part(part_path)
+                continue
+            # 200 means the server ignored the Range, or the remote
+            # file changed: start over, saving its new version
+            resumed = response.status_code == 206
+            if not resumed:
+                validator = get_validator(response)
+                if validator is None:
+                    remove_part(part_path)
+                else:
+                    with open(validator_path, 'w') as validator_file:
+                        validator_file.write(validator)
+            mode = 'ab' if resumed else 'wb'
+            expected = response.headers.get('content-length')
+            received = 0
+            with open(part_path, mode) as part_file:
+                for chunk in response.iter_content(chunk_size):
+                    part_file.write(chunk)
+                    received += len(chunk)
+            if expected is not None and received < int(expected):
+                # Connection closed early, resume on the next attempt
+                if attempt == retries:
+                    raise DownloadError('Incomplete download - ' + url)
+                continue
+            os.rename(part_path, path)
+            remove_part(part_path)
+            return os.path.getsize(path)
+        except (ChunkedEncodingError, ConnectionError, Timeout):
+            if attempt == retries:
+                raise
+        finally:
+            response.close()
+    raise DownloadError('Unable to download - ' + url)
+
+
+def check_zip(path):
+    """
+      Checks a ZIP archive's integrity (CRCs of every file), raising
+      DownloadError and removing the file when it's corrupt, so that
+      the next download starts over.
+    """
+    try:
+        with ZipFile(path, 'r') as zip_file:
+            corrupt_file = zip_file.testzip()
+    except BadZipfile:
+        corrupt_file = path
+    if corrupt_file is not None:
+        os.remove(path)
+        raise DownloadError('Corrupt ZIP file ({}) - {}'.format(
+            corrupt_file,
+            path,
+        ))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from threading import Lock
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .constants import HTTP_POOL_SIZE
+from .constants import HTTP_RETRIES
+from .constants import HTTP_TIMEOUT
+
+
+# Shared sessions, one per host (scheme + netloc)
+SESSIONS = {}
+SESSIONS_LOCK = Lock()
+
+
+class PooledSession(requests.Session):
+    """ Keep-alive session that applies a default timeout to every call """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES):
+        super(PooledSession, self).__init__()
+        self.pool_size = 0
+        self.timeout = timeout
+        self.retries = retries
+        self.resize(pool_size)
+
+    def resize(self, pool_size):
+        """
+          Mounts a new adapter if the connection pool
+          has to hold more than `pool_size` connections.
+        """
+        if pool_size <= self.pool_size:
+            return
+        # Only connection errors are retried here: bad status codes
+        # are handled by whoever is parsing the responses.
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.pool_size = pool_size
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+def get_host(url):
+    """ Returns the scheme and host of an URL (e.g. https://api.ost.pt) """
+    if not url:
+        return ''
+    if '://' not in url:
+        url = 'http://' + url
+    parsed_url = urlparse(url)
+    return '{}://{}'.format(parsed_url.scheme, parsed_url.netloc)
+
+
+def get_session(url, pool_size=HTTP_POOL_SIZE):
+    """
+      Returns the shared session of the URL's host,
+      creating it (or growing its pool) when needed.
+    """
+    host = get_host(url)
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(host)
+        if session is None:
+            session = SESSIONS[host] = PooledSession(pool_size=pool_size)
+        else:
+            session.resize(pool_size)
+    return session
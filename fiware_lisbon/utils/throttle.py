@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import random
+import time
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+from threading import Lock
+
+
+class TokenBucket(object):
+    """
+      Thread-safe token bucket: allows `rate` calls per second on
+      average and bursts of up to `capacity` calls. The rate halves
+      when the server throttles us and creeps back up on success.
+    """
+
+    def __init__(self, rate, capacity=1, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate) if rate else min_rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.time()
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+          Takes a token, sleeping until there's one available.
+          Returns the number of seconds spent waiting.
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.updated_at
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+            # Tokens may go negative, reserving the next ones in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def get_wait(self):
+        """ Returns the seconds a call made now would wait for a token """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            elapsed = time.time() - self.updated_at
+            tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        return (1 - tokens) / self.rate if tokens < 1 else 0.0
+
+    def slow_down(self):
+        """ Halves the rate, after the server said we're too fast """
+        with self.lock:
+            if self.rate:
+                self.rate = max(self.min_rate, self.rate / 2.0)
+
+    def speed_up(self, step=0.05):
+        """ Slowly recovers the rate after successful calls """
+        with self.lock:
+            if self.rate and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + step)
+
+
+class CircuitBreaker(object):
+    """
+      Stops calling a service after `threshold` failures in a row,
+      for `cooldown` seconds. Calls are then let through again and
+      a single failure opens the circuit once more.
+    """
+
+    def __init__(self, threshold=5, cooldown=60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    def is_open(self):
+        """ Checks if calls to the service are blocked """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.time() - self.opened_at < self.cooldown:
+                return True
+            # Half open: the next failure opens the circuit again
+            self.opened_at = None
+            self.failures = self.threshold - 1
+            return False
+
+    def record_success(self):
+        """ Closes the circuit after a successful call """
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        """ Counts a failed call, opening the circuit after too many """
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+class RetryPolicy(object):
+    """
+      Exponential backoff with full jitter. Each error class has its
+      own maximum number of retries (e.g. {'server': 5, 'throttled': 8}).
+    """
+
+    def __init__(self, retries, base=1.0, cap=300.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def should_retry(self, error_class, attempt):
+        """ Checks if the attempt-th failure of error_class is retried """
+        return attempt <= self.retries.get(error_class, 0)
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+          Seconds to wait before the attempt-th retry. A Retry-After
+          header (seconds or HTTP date) takes precedence over backoff.
+        """
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            return min(delay, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """
+      Returns the seconds of a Retry-After header, which can
+      be a number of seconds or an HTTP date, or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, mktime_tz(date) - time.time())
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 # encoding: utf-8
+from collections import deque
 from itertools import chain
 from itertools import izip_longest
-import csv
+from multiprocessing.pool import ThreadPool
 import os
 
 from colorama import Fore
 
 from .errors import CKANError
 from .errors import FiWareError
+from .flatten import records_to_csv
 
 
 CKAN_TYPES = ['datastore', 'package', 'resource']
@@ -16,6 +18,7 @@ CKAN_TYPES = ['datastore', 'package', 'resource']
 CKAN_URLS = {
     'create': '/api/action/{type}_create',
     'delete': '/api/action/{type}_delete',
+    'dump': '/{type}/dump/',
     'search': '/api/action/{type}_search',
     'show': '/api/action/{type}_show',
     'upsert': '/api/action/{type}_upsert',
@@ -30,6 +33,59 @@ def grouper(iterable, n, fillvalue=None):
     return izip_longest(fillvalue=fillvalue, *args)
 
 
+def batches(iterable, size, max_bytes=None, get_size=len):
+    """
+      Collects data into lists of up to `size` items and, if
+      max_bytes is given, up to max_bytes of get_size(item).
+      An item bigger than max_bytes goes alone in its batch.
+    """
+    batch, batch_bytes = [], 0
+    for item in iterable:
+        item_bytes = get_size(item) if max_bytes else 0
+        is_full = len(batch) >= size or \
+            (max_bytes and batch_bytes + item_bytes > max_bytes)
+        if batch and is_full:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        yield batch
+
+
+def imap_bounded(function, iterable, workers):
+    """
+      Maps function over iterable with a pool of threads, yielding
+      the results in order. At most `workers` results are pending
+      at any time, so the pool never runs far ahead of the consumer.
+    """
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(function, (item,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_entity_id(content):
+    """
+      Returns the id of an OST element or, if it has none,
+      the numeric id found in its resource_uri
+    """
+    element_id = content.get('id', '')
+    if not element_id:
+        element_id = {int(string) for string in
+                      content['resource_uri'].split('/')
+                      if string.isdigit()}.pop()
+    return element_id
+
+
 def get_file_path(dataset_name, file_name, file_ext):
     """ Returns the file directory of a data file """
     file_header = 'file://'
@@ -103,10 +159,10 @@ def get_error_message(error):
     return message
 
 
-def get_fiware_api(fiware_host, update=False):
+def get_fiware_api(fiware_host, update=False, version='v1'):
     """
       Gets the correct URL to fetch or insert data
-      from/to the Orion Context Broker
+      from/to the Orion Context Broker (NGSI10 or NGSIv2)
     """
     if not fiware_host:
         raise FiWareError('No Fi-Ware Host')
@@ -114,6 +170,10 @@ def get_fiware_api(fiware_host, update=False):
         fiware_host = fiware_host[:-1]
     if 'http://' not in fiware_host:
         fiware_host = 'http://' + fiware_host
+    if version == 'v2':
+        if update:
+            return fiware_host + '/v2/op/update'
+        return fiware_host + '/v2/entities'
     if update:
         return fiware_host + '/ngsi10/updateContext'
     return fiware_host + '/ngsi10/queryContext'
@@ -141,8 +201,8 @@ def get_string_type(attribute):
     try:
         if attribute.isdigit():
             return 'int'
-        elif float(attribute):
-            return 'float'
+        float(attribute)
+        return 'float'
     except (ValueError, AttributeError):
         return 'string'
 
@@ -174,12 +234,8 @@ def to_keyvalue_pairs(source, ancestors=None, key_delimeter='_'):
 
 
 def dicts_to_csv(source, output_file):
-    def build_row(dict_obj, row_keys):
-        return [dict_obj.get(k) for k in row_keys]
-    keys = sorted(set(chain.from_iterable([o.keys() for o in source])))
-    rows = [build_row(d, keys) for d in source]
-    cw = csv.writer(output_file, lineterminator='\n')
-    cw.writerow(keys)
-    for row in rows:
-        cw.writerow([c.encode('utf-8') if isinstance(c, str) or isinstance(c, unicode) else c for c in row])
-
+    """
+      Writes flat dicts to a CSV file object, with the sorted
+      union of their keys as columns (see utils.flatten)
+    """
+    records_to_csv(source, output_file, sample_size=None)